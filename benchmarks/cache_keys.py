@@ -0,0 +1,86 @@
+"""Compares the tuple keys used by cogs.utils.cache with the old repr/join string keys.
+
+Run from the repository root: ::
+
+    python -m benchmarks.cache_keys
+"""
+import timeit
+
+from cogs.utils import cache
+
+
+def _true_repr(o):
+    if o.__class__.__repr__ is object.__repr__:
+        return f'<{o.__class__.__module__}.{o.__class__.__name__}>'
+    return repr(o)
+
+
+def string_key(func, args, kwargs):
+    """The key strategy cogs.utils.cache used before tuple keys."""
+    key = [f'{func.__module__}.{func.__name__}']
+    key.extend(_true_repr(o) for o in args)
+    for k, v in kwargs.items():
+        if k == 'connection':
+            continue
+        key.append(_true_repr(k))
+        key.append(_true_repr(v))
+    return ':'.join(key)
+
+
+class Cog:
+    @cache.cache()
+    def default_key(self, guild_id):
+        return guild_id
+
+    @cache.cache(key=cache.skip_self)
+    def skip_self_key(self, guild_id):
+        return guild_id
+
+
+def main(guilds=1000, number=200000):
+    cog = Cog()
+    guild_ids = [281203000000000000 + n for n in range(guilds)]
+    guild_id = guild_ids[7]
+    func = Cog.default_key
+
+    results = {
+        'string key': timeit.timeit(lambda: string_key(func, (cog, guild_id), {}), number=number),
+        'tuple key': timeit.timeit(lambda: Cog.default_key.get_key(cog, guild_id), number=number),
+        'skip_self key': timeit.timeit(lambda: Cog.skip_self_key.get_key(cog, guild_id), number=number),
+    }
+
+    strings = {}
+    for g in guild_ids:
+        cog.default_key(g)
+        cog.skip_self_key(g)
+        strings[string_key(func, (cog, g), {})] = g
+
+    def string_hit():
+        return strings[string_key(func, (cog, guild_id), {})]
+
+    results['string hit'] = timeit.timeit(string_hit, number=number)
+    results['tuple hit'] = timeit.timeit(lambda: cog.default_key(guild_id), number=number)
+    results['skip_self hit'] = timeit.timeit(lambda: cog.skip_self_key(guild_id), number=number)
+
+    needle = repr(guild_id)
+
+    def string_invalidate():
+        strings[string_key(func, (cog, guild_id), {})] = guild_id
+        for k in [k for k in strings if needle in k]:
+            del strings[k]
+
+    def indexed_invalidate():
+        cog.default_key(guild_id)
+        Cog.default_key.invalidate_containing(guild_id)
+
+    # the substring scan is slow enough that fewer rounds are plenty
+    results['substring invalidate'] = timeit.timeit(string_invalidate, number=number // 100) * 100
+    results['indexed invalidate'] = timeit.timeit(indexed_invalidate, number=number)
+
+    print(f'{guilds} cached guilds')
+    for name, seconds in results.items():
+        print(f'{name:<22} {seconds / number * 1e9:>10.0f} ns/op')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,331 @@
+"""A local stand-in for the Clash of Clans API.
+
+Serves the clan, clan members and player endpoints from synthetic data, and
+just enough of the developer site (login and keys) for ``coc.login`` to
+succeed, so the bot, the polling workers and the benchmarks run without
+Supercell credentials or network access. Point the bot at it with: ::
+
+    "coc_api": {"url": "http://127.0.0.1:8800"}
+
+and run it from the repository root: ::
+
+    python -m benchmarks.cocserver --latency 0.05 --throttle-rate 0.01 --error-rate 0.001
+
+Any clan tag exists, with ``--members`` members tagged ``<clan tag>P<n>``,
+the same scheme ``migrations seed`` uses, so a seeded database and the
+stand-in agree on every player. Players in a clan that was never fetched
+are put in the clan their tag implies, or ``#STANDIN``. A player's trophies
+drift by a random attack or defence every ``1 / --attack-rate`` seconds on
+average, and ``--active`` is the share of players that push at all.
+
+``GET /stats`` returns request counts per endpoint and status.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import random
+import re
+import time
+import uuid
+import zlib
+
+from collections import Counter
+from urllib.parse import unquote
+
+from aiohttp import web
+
+_seeded_player = re.compile(r'^(#C\d+)P\d+$')
+_tag_route = re.compile(r'#[0-9A-Z]+')
+
+
+class Player:
+    __slots__ = ('tag', 'name', 'clan_tag', 'trophies', 'best_trophies', 'attack_wins', 'defense_wins',
+                 'active', 'updated', 'rng')
+
+    def __init__(self, tag, clan_tag, rng, active):
+        # drift keeps drawing from the same generator, so a seed replays every trajectory
+        self.rng = rng
+        self.tag = tag
+        self.name = f'player {tag[-4:]}'
+        self.clan_tag = clan_tag
+        self.trophies = rng.randint(4000, 5000)
+        self.best_trophies = self.trophies
+        self.attack_wins = rng.randint(0, 50)
+        self.defense_wins = rng.randint(0, 10)
+        self.active = active
+        self.updated = time.monotonic()
+
+
+class World:
+    """Every clan and player handed out so far, created on first request."""
+
+    def __init__(self, *, members=25, attack_rate=1 / 600, active=0.3, seed=0):
+        self.members = members
+        self.attack_rate = attack_rate
+        self.active = active
+        self.seed = seed
+        self.clans = {}
+        self.players = {}
+
+    def _rng(self, tag):
+        return random.Random(zlib.crc32(tag.encode()) ^ self.seed)
+
+    def clan(self, tag):
+        if tag not in self.clans:
+            self.clans[tag] = [self.player(f'{tag}P{n}', clan_tag=tag).tag for n in range(1, self.members + 1)]
+        return self.clans[tag]
+
+    def player(self, tag, clan_tag=None):
+        player = self.players.get(tag)
+        if player is None:
+            if clan_tag is None:
+                match = _seeded_player.match(tag)
+                clan_tag = match.group(1) if match else '#STANDIN'
+            rng = self._rng(tag)
+            player = self.players[tag] = Player(tag, clan_tag, rng, rng.random() < self.active)
+        self.drift(player)
+        return player
+
+    def drift(self, player):
+        now = time.monotonic()
+        elapsed = now - player.updated
+        player.updated = now
+        if not player.active:
+            return
+        # poisson arrivals, at most a day's worth at once
+        rng = player.rng
+        budget = min(elapsed, 86400.0)
+        while True:
+            budget -= rng.expovariate(self.attack_rate)
+            if budget < 0:
+                break
+            if rng.random() < 0.6:
+                player.trophies += rng.randint(5, 40)
+                player.attack_wins += 1
+            else:
+                player.trophies = max(0, player.trophies - rng.randint(5, 40))
+                player.defense_wins += 1
+            player.best_trophies = max(player.best_trophies, player.trophies)
+
+    def member_json(self, player, rank):
+        return {
+            'tag': player.tag,
+            'name': player.name,
+            'role': 'member',
+            'expLevel': 150,
+            'league': _league(player.trophies),
+            'trophies': player.trophies,
+            'versusTrophies': 3000,
+            'clanRank': rank,
+            'previousClanRank': rank,
+            'donations': 0,
+            'donationsReceived': 0,
+        }
+
+    def clan_json(self, tag, *, members=True):
+        tags = self.clan(tag)
+        players = sorted((self.player(n) for n in tags), key=lambda p: p.trophies, reverse=True)
+        data = {
+            'tag': tag,
+            'name': f'clan {tag[1:]}',
+            'type': 'inviteOnly',
+            'description': 'stand-in clan',
+            'badgeUrls': _badge(),
+            'clanLevel': 10,
+            'clanPoints': sum(p.trophies for p in players) // 2,
+            'clanVersusPoints': 30000,
+            'requiredTrophies': 4000,
+            'warFrequency': 'always',
+            'warWinStreak': 0,
+            'warWins': 100,
+            'isWarLogPublic': True,
+            'members': len(players),
+        }
+        if members:
+            data['memberList'] = [self.member_json(p, n) for n, p in enumerate(players, 1)]
+        return data, players
+
+    def player_json(self, tag):
+        player = self.player(tag)
+        return {
+            'tag': player.tag,
+            'name': player.name,
+            'townHallLevel': 12,
+            'expLevel': 150,
+            'trophies': player.trophies,
+            'bestTrophies': player.best_trophies,
+            'warStars': 500,
+            'attackWins': player.attack_wins,
+            'defenseWins': player.defense_wins,
+            'builderHallLevel': 8,
+            'versusTrophies': 3000,
+            'bestVersusTrophies': 3200,
+            'versusBattleWins': 300,
+            'role': 'member',
+            'donations': 0,
+            'donationsReceived': 0,
+            'clan': {'tag': player.clan_tag, 'name': f'clan {player.clan_tag[1:]}', 'clanLevel': 10,
+                     'badgeUrls': _badge()},
+            'league': _league(player.trophies),
+            'achievements': [],
+            'labels': [],
+            'troops': [],
+            'heroes': [],
+            'spells': [],
+        }
+
+
+def _badge():
+    url = 'https://api-assets.clashofclans.com/badges/200/standin.png'
+    return {'small': url, 'medium': url, 'large': url}
+
+
+def _league(trophies):
+    url = 'https://api-assets.clashofclans.com/leagues/72/standin.png'
+    if trophies >= 5000:
+        league_id, name = 29000022, 'Legend League'
+    elif trophies >= 4100:
+        league_id, name = 29000021, 'Titan League I'
+    else:
+        league_id, name = 29000018, 'Champion League I'
+    return {'id': league_id, 'name': name, 'iconUrls': {'small': url, 'tiny': url, 'medium': url}}
+
+
+def _temporary_token():
+    # coc.py reads the caller's IP out of the middle part of this token
+    claims = {'limits': [{'tier': 'developer/silver', 'type': 'throttling'},
+                         {'cidrs': ['127.0.0.1/32'], 'type': 'client'}]}
+    payload = base64.b64encode(json.dumps(claims).encode()).decode().rstrip('=')
+    return f'standin.{payload}.standin'
+
+
+class StandIn:
+    """The aiohttp application, with the fault injection around every API request."""
+
+    def __init__(self, world, *, latency=0.0, jitter=0.5, throttle_rate=0.0, max_rps=None, error_rate=0.0,
+                 max_age=60, seed=0):
+        self.world = world
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.max_rps = max_rps
+        self.error_rate = error_rate
+        self.max_age = max_age
+        self.rng = random.Random(seed)
+        self.keys = []
+        self.stats = Counter()
+        self._tokens = max_rps or 0.0
+        self._filled = time.monotonic()
+
+    def app(self):
+        app = web.Application(middlewares=[self.faults])
+        app.router.add_get('/v1/clans/{tag}', self.get_clan)
+        app.router.add_get('/v1/clans/{tag}/members', self.get_members)
+        app.router.add_get('/v1/players/{tag}', self.get_player)
+        app.router.add_post('/api/login', self.login)
+        app.router.add_post('/api/apikey/list', self.list_keys)
+        app.router.add_post('/api/apikey/create', self.create_key)
+        app.router.add_post('/api/apikey/revoke', self.revoke_key)
+        app.router.add_get('/stats', self.get_stats)
+        return app
+
+    def _throttled(self):
+        if self.rng.random() < self.throttle_rate:
+            return True
+        if not self.max_rps:
+            return False
+        now = time.monotonic()
+        self._tokens = min(self.max_rps, self._tokens + (now - self._filled) * self.max_rps)
+        self._filled = now
+        if self._tokens < 1:
+            return True
+        self._tokens -= 1
+        return False
+
+    @web.middleware
+    async def faults(self, request, handler):
+        if not request.path.startswith('/v1/'):
+            return await handler(request)
+        label = f'{request.method} {_tag_route.sub("{tag}", unquote(request.path))}'
+        if self.latency:
+            await asyncio.sleep(max(0.0, self.rng.gauss(self.latency, self.latency * self.jitter)))
+        if self._throttled():
+            response = _error(429, 'requestThrottled', 'Request was throttled, because amount of requests '
+                                                       'was above the threshold defined for the used API token.')
+        elif self.rng.random() < self.error_rate:
+            response = _error(503, 'inMaintenance', 'The stand-in is failing on purpose.')
+        else:
+            response = await handler(request)
+        self.stats[(label, response.status)] += 1
+        return response
+
+    def _json(self, data):
+        return web.json_response(data, headers={'Cache-Control': f'public, max-age={self.max_age}'})
+
+    async def get_clan(self, request):
+        data, _ = self.world.clan_json(unquote(request.match_info['tag']).upper())
+        return self._json(data)
+
+    async def get_members(self, request):
+        data, players = self.world.clan_json(unquote(request.match_info['tag']).upper(), members=False)
+        items = [self.world.member_json(p, n) for n, p in enumerate(players, 1)]
+        return self._json({'items': items, 'paging': {'cursors': {}}})
+
+    async def get_player(self, request):
+        tag = unquote(request.match_info['tag']).upper()
+        if not _tag_route.fullmatch(tag):
+            return _error(404, 'notFound', 'No player with that tag.')
+        return self._json(self.world.player_json(tag))
+
+    async def login(self, request):
+        return web.json_response({'status': {'code': 0, 'message': 'ok'},
+                                  'developer': {'id': 'standin'},
+                                  'temporaryAPIToken': _temporary_token()})
+
+    async def list_keys(self, request):
+        return web.json_response({'keys': self.keys})
+
+    async def create_key(self, request):
+        data = await request.json()
+        key = {'id': uuid.uuid4().hex, 'name': data.get('name'), 'description': data.get('description'),
+               'cidrRanges': data.get('cidrRanges', ['127.0.0.1']), 'key': uuid.uuid4().hex}
+        self.keys.append(key)
+        return web.json_response({'key': key})
+
+    async def revoke_key(self, request):
+        data = await request.json()
+        self.keys = [n for n in self.keys if n['id'] != data.get('id')]
+        return web.json_response({})
+
+    async def get_stats(self, request):
+        by_endpoint = {}
+        for (label, status), count in sorted(self.stats.items()):
+            by_endpoint.setdefault(label, {})[str(status)] = count
+        return web.json_response({'clans': len(self.world.clans), 'players': len(self.world.players),
+                                  'requests': by_endpoint})
+
+
+def _error(status, reason, message):
+    return web.json_response({'reason': reason, 'message': message}, status=status)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.cocserver')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8800)
+    parser.add_argument('--members', type=int, default=25, help='members per clan')
+    parser.add_argument('--attack-rate', type=float, default=1 / 600,
+                        help='trophy changes per second for an active player')
+    parser.add_argument('--active', type=float, default=0.3, help='share of players that push')
+    parser.add_argument('--latency', type=float, default=0.0, help='mean response latency in seconds')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of requests answered with 429')
+    parser.add_argument('--max-rps', type=float, help='answer 429 above this many requests a second')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with 503')
+    parser.add_argument('--max-age', type=int, default=60, help='Cache-Control max-age of every response')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    world = World(members=args.members, attack_rate=args.attack_rate, active=args.active, seed=args.seed)
+    stand_in = StandIn(world, latency=args.latency, throttle_rate=args.throttle_rate, max_rps=args.max_rps,
+                       error_rate=args.error_rate, max_age=args.max_age, seed=args.seed)
+    web.run_app(stand_in.app(), host=args.host, port=args.port)
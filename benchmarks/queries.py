@@ -0,0 +1,277 @@
+"""Times the PushBoard, Events and GuildConfig queries against a season sized database.
+
+Seeds an empty local database with 500 guilds, 2k clans, 50k players and
+20M coc_events, then runs every statement many times from concurrent
+connections and reports p50/p99 latency. Writes run inside a transaction
+that is rolled back, so the dataset stays the same between runs.
+
+Run from the repository root: ::
+
+    python -m benchmarks.queries postgres://localhost/pushbot_bench --seed
+    python -m benchmarks.queries postgres://localhost/pushbot_bench --json results.json
+
+``--scale 0.01`` seeds a hundredth of the coc_events for a quick run.
+The JSON output can be compared across commits.
+"""
+import argparse
+import asyncio
+import asyncpg
+import contextlib
+import json
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+from datetime import datetime
+
+from cogs.utils import migrations
+from cogs.utils.db import catalog
+
+GUILDS = 500
+CLANS_PER_GUILD = 4
+PLAYERS_PER_CLAN = 25
+EVENTS_PER_PLAYER = 400
+
+# inline statements that aren't in the catalog yet
+INLINE = {
+    'guildconfig.latest_event': ("SELECT event_id FROM events WHERE guild_id = $1 "
+                                 "ORDER BY event_start_time DESC", 'read'),
+    'guildconfig.clan_in_event': ("SELECT clan_tag, event_id FROM clans WHERE event_id = $1 AND clan_tag = $2",
+                                  'read'),
+    'guildconfig.upcoming_event': ("SELECT event_id FROM events WHERE guild_id = $1 "
+                                   "AND event_end_time > CURRENT_TIMESTAMP ORDER BY event_end_time", 'read'),
+    'guildconfig.event_clans': ("SELECT clan_name, clan_tag FROM clans WHERE event_id = $1 ORDER BY clan_name",
+                                'read'),
+    'events.log_info_guild': ("SELECT event_id, guild_id, event_name, channel_id, log_interval, log_toggle "
+                              "FROM events WHERE guild_id = $1", 'read'),
+    'events.log_interval': ("UPDATE events SET log_interval = ($1 ||' minutes')::interval "
+                            "WHERE channel_id = $2 RETURNING event_name", 'write'),
+    'pushboard.info_clans': ("SELECT clan_name, clan_tag FROM clans WHERE guild_id = $1", 'read'),
+}
+
+
+class Samples:
+    """Real keys drawn from the seeded tables, so every lookup hits."""
+
+    def __init__(self, rng, guilds, events, clans, players, messages, timers):
+        self.rng = rng
+        self.guilds = guilds
+        self.events = events
+        self.clans = clans
+        self.players = players
+        self.messages = messages
+        self.timers = timers
+
+    @classmethod
+    async def load(cls, connection, rng):
+        async def column(sql):
+            return [n[0] for n in await connection.fetch(sql)]
+
+        return cls(rng,
+                   guilds=await column("SELECT guild_id FROM guilds"),
+                   events=await connection.fetch("SELECT event_id, guild_id, channel_id FROM events"),
+                   clans=await connection.fetch("SELECT clan_tag, event_id, guild_id FROM clans"),
+                   players=await column("SELECT player_tag FROM players"),
+                   messages=await column("SELECT message_id FROM messages"),
+                   timers=await column("SELECT id FROM log_timers"))
+
+    def pick(self, items, k=None):
+        if k is None:
+            return self.rng.choice(items)
+        return self.rng.sample(items, min(k, len(items)))
+
+    def trophy_batch(self, size=50):
+        now = datetime.utcnow().isoformat()
+        return [{'player_tag': tag, 'trophies': 4000 + self.rng.randint(-30, 30), 'time_stamp': now}
+                for tag in self.pick(self.players, size)]
+
+    def poll_batch(self, size=50):
+        now = datetime.utcnow().isoformat()
+        return [{'player_tag': tag, 'player_name': 'bench', 'clan_tag': '#BENCH', 'clan_name': 'bench',
+                 'old_trophies': 4000, 'new_trophies': 4000 + self.rng.randint(-30, 30), 'polled_at': now}
+                for tag in self.pick(self.players, size)]
+
+    def new_members(self, size=5):
+        clan_tag = self.pick(self.clans)['clan_tag']
+        return [{'player_tag': f'#NEW{self.rng.randrange(10 ** 9)}', 'player_name': 'bench', 'clan_tag': clan_tag,
+                 'trophies': self.rng.randint(3000, 5000)} for _ in range(size)]
+
+    def event_batch(self, size=50):
+        now = datetime.utcnow().isoformat()
+        return [{'player_tag': tag, 'player_name': 'bench', 'clan_tag': '#BENCH', 'clan_name': 'bench',
+                 'trophy_change': self.rng.randint(-30, 30), 'time_stamp': now}
+                for tag in self.pick(self.players, size)]
+
+
+# statement name -> arguments for one run
+ARGS = {
+    'guild_config': lambda s: (s.pick(s.guilds),),
+    'guild_clan_tags': lambda s: (s.pick(s.guilds),),
+    'guilds_for_clans': lambda s: ([c['clan_tag'] for c in s.pick(s.clans, 20)],),
+    'claims_for_clan': lambda s: (s.pick(s.clans)['clan_tag'],),
+    'clan_players': lambda s: (s.pick(s.clans)['clan_tag'],),
+    'insert_players': lambda s: (s.new_members(),),
+    'delete_clan_players': lambda s: (s.pick(s.clans)['clan_tag'],),
+    'leaderboard_players': lambda s: (s.pick(s.players, 200),),
+    'apply_trophy_changes': lambda s: (s.trophy_batch(),),
+    'enqueue_poll_events': lambda s: (s.poll_batch(),),
+    'claim_poll_events': lambda s: (500, 600.0),
+    'ack_poll_events': lambda s: ([s.rng.randrange(10 ** 6) for _ in range(500)],),
+    'guild_messages': lambda s: (s.pick(s.guilds),),
+    'message': lambda s: (s.pick(s.messages),),
+    'insert_message': lambda s: (s.pick(s.guilds), s.rng.randint(10 ** 17, 10 ** 18), 1),
+    'delete_message': lambda s: (s.pick(s.messages),),
+    'insert_coc_events': lambda s: (s.event_batch(),),
+    'unreported_events': lambda s: (s.pick(s.events)['channel_id'],),
+    'channel_config': lambda s: (s.pick(s.events)['channel_id'],),
+    'channel_configs': lambda s: ([e['channel_id'] for e in s.pick(s.events, 20)],),
+    'insert_log_timer': lambda s: (1, 'bench', datetime.utcnow()),
+    'delete_log_timer': lambda s: (s.pick(s.timers),),
+    'recent_guild': lambda s: (s.pick(s.guilds), 20),
+    'recent_player': lambda s: (s.pick(s.players), 20),
+    'recent_clans': lambda s: ([c['clan_tag'] for c in s.pick(s.clans, 4)], 20),
+    'guildconfig.latest_event': lambda s: (s.pick(s.guilds),),
+    'guildconfig.clan_in_event': lambda s: (lambda c: (c['event_id'], c['clan_tag']))(s.pick(s.clans)),
+    'guildconfig.upcoming_event': lambda s: (s.pick(s.guilds),),
+    'guildconfig.event_clans': lambda s: (s.pick(s.events)['event_id'],),
+    'events.log_info_guild': lambda s: (s.pick(s.guilds),),
+    'events.log_interval': lambda s: ('5', s.pick(s.events)['channel_id']),
+    'pushboard.info_clans': lambda s: (s.pick(s.guilds),),
+}
+
+
+def statements():
+    for q in catalog.values():
+        yield q.name, q.sql, q.kind
+    for name, (sql, kind) in INLINE.items():
+        yield name, sql, kind
+
+
+def percentile(values, p):
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))
+    return values[index]
+
+
+async def _run_one(pool, sql, kind, args):
+    async with pool.acquire() as connection:
+        start = time.perf_counter()
+        if kind == 'write':
+            tr = connection.transaction()
+            await tr.start()
+            try:
+                await connection.fetch(sql, *args)
+            finally:
+                await tr.rollback()
+        else:
+            await connection.fetch(sql, *args)
+        return time.perf_counter() - start
+
+
+async def bench_statement(pool, samples, name, sql, kind, *, iterations, concurrency):
+    make_args = ARGS.get(name, lambda s: ())
+    timings = []
+    errors = 0
+    remaining = iterations
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            try:
+                timings.append(await _run_one(pool, sql, kind, make_args(samples)))
+            except asyncpg.PostgresError:
+                errors += 1
+
+    # a warm up run keeps the first planning out of the timings
+    await _run_one(pool, sql, kind, make_args(samples))
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    if not timings:
+        return {'name': name, 'kind': kind, 'runs': 0, 'errors': errors}
+    return {
+        'name': name,
+        'kind': kind,
+        'runs': len(timings),
+        'errors': errors,
+        'p50_ms': percentile(timings, 50) * 1000,
+        'p99_ms': percentile(timings, 99) * 1000,
+        'mean_ms': statistics.mean(timings) * 1000,
+        'max_ms': max(timings) * 1000,
+        'throughput': len(timings) / elapsed,
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def _init(connection):
+    await connection.set_type_codec('jsonb', encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
+
+
+async def main(args):
+    connection = await asyncpg.connect(args.dsn)
+    try:
+        await migrations.migrate(connection)
+        if args.seed:
+            print('seeding, this takes a while at full scale...', file=sys.stderr)
+            await migrations.seed(connection, guilds=GUILDS, clans_per_guild=CLANS_PER_GUILD,
+                                  players_per_clan=PLAYERS_PER_CLAN,
+                                  events_per_player=max(1, round(EVENTS_PER_PLAYER * args.scale)),
+                                  random_seed=args.random_seed)
+        counts = {table: await connection.fetchval("SELECT reltuples::BIGINT FROM pg_class WHERE relname = $1",
+                                                   table)
+                  for table in ('guilds', 'clans', 'players', 'coc_events', 'messages')}
+        samples = await Samples.load(connection, random.Random(args.random_seed))
+    finally:
+        await connection.close()
+
+    pool = await asyncpg.create_pool(args.dsn, min_size=args.concurrency, max_size=args.concurrency, init=_init)
+    results = []
+    try:
+        for name, sql, kind in statements():
+            if args.only and args.only not in name:
+                continue
+            result = await bench_statement(pool, samples, name, sql, kind,
+                                           iterations=args.iterations, concurrency=args.concurrency)
+            results.append(result)
+            if not args.json:
+                if result['runs']:
+                    print(f"{name:<30} p50 {result['p50_ms']:>9.2f} ms  p99 {result['p99_ms']:>9.2f} ms  "
+                          f"{result['throughput']:>8.0f}/s  errors {result['errors']}")
+                else:
+                    print(f"{name:<30} every run failed")
+    finally:
+        await pool.close()
+
+    if args.json:
+        report = {
+            'commit': _git_commit(),
+            'timestamp': datetime.utcnow().isoformat(),
+            'concurrency': args.concurrency,
+            'iterations': args.iterations,
+            'rows': counts,
+            'statements': results,
+        }
+        with open(args.json, 'w') if args.json != '-' else contextlib.nullcontext(sys.stdout) as fp:
+            json.dump(report, fp, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.queries')
+    parser.add_argument('dsn')
+    parser.add_argument('--seed', action='store_true', help='seed the (empty) database first')
+    parser.add_argument('--scale', type=float, default=1.0, help='fraction of the 20M coc_events to seed')
+    parser.add_argument('--random-seed', type=float, default=0.5)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--iterations', type=int, default=500, help='runs per statement')
+    parser.add_argument('--only', help='only statements whose name contains this')
+    parser.add_argument('--json', help='write machine readable results here, - for stdout')
+    asyncio.get_event_loop().run_until_complete(main(parser.parse_args()))
@@ -0,0 +1,88 @@
+"""Compares the lazy record views in cogs.utils.db_objects with the old eager copies.
+
+Rows are dicts, which offer the same ``[]``/``get``/``items`` interface as
+an asyncpg Record. Run from the repository root: ::
+
+    python -m benchmarks.records
+"""
+import gc
+import timeit
+import tracemalloc
+
+from datetime import datetime
+
+from cogs.utils.db_objects import DatabaseEvent, DatabasePlayer
+
+
+class EagerPlayer:
+    """DatabasePlayer as it was before the record views."""
+    def __init__(self, *, bot, record):
+        self.bot = bot
+        self.id = record.get('player_id')
+        self.player_name = record.get('player_name')
+        self.player_tag = record['player_tag']
+        self.current_trophies = record['current_trophies']
+        self.attacks = record['attacks']
+        self.user_id = record.get('user_id')
+
+
+class EagerEvent:
+    """DatabaseEvent as it was before the record views."""
+    def __init__(self, *, bot, record):
+        self.bot = bot
+        self.id = record['coc_event_id']
+        self.player_tag = record['player_tag']
+        self.clan_tag = record['clan_tag']
+        self.trophy_change = record['trophy_change']
+        self.time = record['time_stamp']
+
+
+def player_rows(count):
+    # the columns leaderboard_players selects
+    return [{'player_tag': f'#P{n}', 'current_trophies': 4000 + n % 1000, 'attacks': n % 50}
+            for n in range(count)]
+
+
+def event_rows(count):
+    now = datetime.utcnow()
+    return [{'coc_event_id': n, 'player_tag': f'#P{n}', 'player_name': f'player {n}', 'clan_tag': '#C1',
+             'clan_name': 'clan', 'trophy_change': n % 60 - 30, 'time_stamp': now, 'reported': False}
+            for n in range(count)]
+
+
+def retained(cls, rows):
+    """Bytes still allocated after wrapping ``rows``, not counting the rows themselves."""
+    gc.collect()
+    tracemalloc.start()
+    wrapped = [cls(bot=None, record=r) for r in rows]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del wrapped
+    return size
+
+
+def main(rows=10000, number=20):
+    cases = (
+        ('player', EagerPlayer, DatabasePlayer, player_rows(rows), ('player_tag', 'current_trophies')),
+        ('event', EagerEvent, DatabaseEvent, event_rows(rows), ('clan_tag', 'trophy_change', 'time')),
+    )
+    print(f'{rows} rows')
+    for name, eager, lazy, data, used in cases:
+        for label, cls in (('eager', eager), ('lazy', lazy)):
+            def build():
+                return [cls(bot=None, record=r) for r in data]
+
+            def build_and_read():
+                for obj in build():
+                    for attr in used:
+                        getattr(obj, attr)
+
+            built = timeit.timeit(build, number=number) / number
+            read = timeit.timeit(build_and_read, number=number) / number
+            size = retained(cls, data)
+            print(f'{name:<7} {label:<6} build {built * 1000:>7.2f} ms   build+read {read * 1000:>7.2f} ms   '
+                  f'{size / 1024:>8.0f} KiB ({size / rows:.0f} B/row)')
+
+
+if __name__ == '__main__':
+    main()
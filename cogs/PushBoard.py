@@ -2,12 +2,19 @@ import asyncio
 import asyncpg
 import coc
 import discord
+import json
 import math
+import time
 from datetime import datetime
 from discord.ext import commands, tasks
-from cogs.utils.db_objects import DatabaseGuild, DatabaseMessage, DatabasePlayer
+from cogs.utils.db_objects import DatabaseGuild, DatabaseMessage, DatabasePlayer, MessageHandle
 from cogs.utils.formatters import CLYTable
 from cogs.utils import checks, cache
+from cogs.utils.metrics import registry, BUFFER_DEPTH, FLUSH_ROWS, FLUSH_SECONDS
+from cogs.utils.workers import polled_at
+
+REFRESH_SECONDS = registry.histogram('pushbot_pushboard_refresh_seconds',
+                                     'Time taken to refresh a guild\'s pushboard', ('guild',))
 
 
 class MockPlayer:
@@ -24,9 +31,11 @@ class PushBoard(commands.Cog):
         self.player_updates = []
         self._to_be_deleted = set()
         self._join_prompts = {}
+        # message_id -> MessageHandle, bounded to roughly 1MB
+        self._messages = cache.SizedLRU("cogs.PushBoard.PushBoard.messages", 1024 * 1024)
         self.bot.coc.add_events(self.on_player_trophies_change)
+        self.bot.poll_queue.register_buffer("PushBoard")
         self.bot.coc._clan_retry_interval = 60
-        self.bot.coc.start_updates("player")
 
         self._batch_lock = asyncio.Lock(loop=bot.loop)
         self._data_batch = []
@@ -36,11 +45,16 @@ class PushBoard(commands.Cog):
         self.update_pushboard_loop.add_exception_type(asyncpg.PostgresConnectionError)
         self.update_pushboard_loop.add_exception_type(coc.ClashOfClansException)
         self.update_pushboard_loop.start()
+        self.bot.invalidation.register("guild_config", self.on_guild_config_invalidated)
+        self.bot.invalidation.register("message", self.on_message_invalidated)
 
     def cog_unload(self):
         self.bulk_insert_loop.cancel()
         self.update_pushboard_loop.cancel()
+        self.bot.invalidation.unregister("guild_config")
+        self.bot.invalidation.unregister("message")
         self.bot.coc.remove_events(self.on_player_trophies_change)
+        self.bot.poll_queue.unregister_buffer("PushBoard")
 
     @tasks.loop(seconds=60.0)
     async def bulk_insert_loop(self):
@@ -53,60 +67,83 @@ class PushBoard(commands.Cog):
             clan_tags = list(self._clan_events)
             self._clan_events.clear()
 
-        sql = ("SELECT DISTINCT guild_id FROM events e "
-               "INNER JOIN clans c ON e.event_id = c.event_id "
-               "WHERE clan_tag = ANY($1::TEXT[])")
-        fetch = await self.bot.pool.fetch(sql, clan_tags)
+        fetch = await self.bot.db.fetch("guilds_for_clans", clan_tags)
         for n in fetch:
-            await self.update_pushboard(n["guild_id"])
+            with REFRESH_SECONDS.time(guild=n["guild_id"]):
+                await self.update_pushboard(n["guild_id"])
 
     async def bulk_insert(self):
-        sql = ("UPDATE players p "
-               "SET p.current_trophies = p.current_trophies + json.trophy_change "
-               "FROM(SELECT json.player_tag, json.trophy_change "
-               "FROM jsonb_to_recordset($1::jsonb) "
-               "AS json(player_tag TEXT, trophy_change INTEGER)) "
-               "AS json "
-               "WHERE p.player_tag = json.player_tag")
+        start = time.perf_counter()
         if self._data_batch:
-            await self.bot.pool.execute(sql, self._data_batch)
+            await self.bot.db.execute("apply_trophy_changes", self._data_batch)
             total = len(self._data_batch)
             if total > 1:
                 self.bot.logger.info(f"Registered {total} trophy changes to the database.")
             self._data_batch.clear()
+            BUFFER_DEPTH.set(0, cog="PushBoard")
+            FLUSH_ROWS.observe(total, cog="PushBoard")
+            FLUSH_SECONDS.observe(time.perf_counter() - start, cog="PushBoard")
+        self.bot.poll_queue.flushed("PushBoard")
 
-    @cache.cache()
+    @cache.cache(strategy=cache.Strategy.revalidate, key=cache.skip_self, maxsize=1024,
+                 soft_ttl=300.0, hard_ttl=86400.0)
     async def get_guild_config(self, guild_id):
         # TODO replace *
-        sql = "SELECT * FROM guilds WHERE guild_id = $1"
-        fetch = await self.bot.pool.fetchrow(sql, guild_id)
+        fetch = await self.bot.db.fetchrow("guild_config", guild_id, fresh=True)
         return DatabaseGuild(guild_id=guild_id,
                              bot=self.bot,
                              record=fetch)
 
-    @cache.cache()
     async def get_message(self, channel, message_id):
+        """Returns a :class:`MessageHandle` for the message, or ``None`` if it is gone."""
+        handle = self._messages.get(message_id)
+        if handle is not None:
+            return handle
+        if channel is None:
+            return None
         try:
             obj = discord.Object(id=message_id + 1)
             msg = await channel.history(limit=1, before=obj).next()
             if msg.id != message_id:
                 return None
-            return msg
         except Exception:
             return None
+        handle = self._messages[message_id] = MessageHandle(channel.id, message_id)
+        return handle
+
+    async def edit_message(self, handle, *, embed):
+        """Edits a pushboard message unless it already shows ``embed``."""
+        data = embed.to_dict()
+        # the "Last Updated" timestamp changes every time and shouldn't force an edit
+        data.pop("timestamp", None)
+        render_hash = hash(json.dumps(data, sort_keys=True))
+        if render_hash == handle.render_hash:
+            return
+        await self.bot.http.edit_message(handle.channel_id, handle.message_id,
+                                         content=None, embed=embed.to_dict())
+        handle.render_hash = render_hash
+
+    def on_guild_config_invalidated(self, guild_id):
+        if guild_id is None:
+            return self.get_guild_config.invalidate_all()
+        # only reload guilds this process actually serves
+        if self.get_guild_config.get_key(self, guild_id) in self.get_guild_config.cache:
+            self.get_guild_config.refresh(self, guild_id)
+
+    def on_message_invalidated(self, message_id):
+        if message_id is None:
+            return self._messages.clear()
+        self._messages.pop(message_id)
 
     async def new_pushboard_message(self, guild_id):
         guild_config = await self.get_guild_config(guild_id)
         new_msg = await guild_config.pushboard.send("New Leaderboard incoming...")
-        sql = ("INSERT INTO message (guild_id, message_id, channel_id) "
-               "VALUES ($1, $2, $3)")
-        await self.bot.pool.execute(sql, new_msg.guild.id, new_msg.id, new_msg.channel.id)
-        return new_msg
+        await self.bot.db.execute("insert_message", new_msg.guild.id, new_msg.id, new_msg.channel.id)
+        handle = self._messages[new_msg.id] = MessageHandle(new_msg.channel.id, new_msg.id)
+        return handle
 
     async def safe_delete(self, message_id, delete_message=True):
-        sql = ("DELETE FROM messages WHERE message_id = $1 "
-               "RETURNING id, guild_id, message_id, channel_id")
-        fetch = await self.bot.pool.fetchrow(sql, message_id)
+        fetch = await self.bot.db.fetchrow("delete_message", message_id)
         if not fetch:
             return None
         message = DatabaseMessage(bot=self.bot, record=fetch)
@@ -116,21 +153,15 @@ class PushBoard(commands.Cog):
         m = await message.get_message()
         if not m:
             return
-        await m.delete()
+        self._messages.pop(message_id)
+        await self.bot.http.delete_message(m.channel_id, m.message_id)
 
     async def get_message_database(self, message_id):
-        sql = ("SELECT id, guild_id, message_id, channel_id "
-               "FROM messages WHERE message_id = $1")
-        fetch = await self.bot.pool.fetchrow(sql, message_id)
+        fetch = await self.bot.db.fetchrow("message", message_id, fresh=True)
         if not fetch:
             return None
         return DatabaseMessage(bot=self.bot, record=fetch)
 
-    async def update_clan_tags(self):
-        sql = "SELECT DISTINCT player_tag FROM players"
-        fetch = await self.bot.pool.fetch(sql)
-        self.bot.coc._player_updates = [n[0] for n in fetch]
-
     @commands.Cog.listener()
     async def on_guild_channel_delete(self, channel):
         if not isinstance(channel, discord.TextChannel):
@@ -141,10 +172,11 @@ class PushBoard(commands.Cog):
         sql = "DELETE FROM messages WHERE channel_id = $1"
         await self.bot.pool.execute(sql, channel.id)
         sql = ("UPDATE guilds "
-               "SET pushboard_channel_id = NULL, "
-               "pushboard_toggle = False "
+               "SET updates_channel_id = NULL, "
+               "updates_toggle = False "
                "WHERE guild_id = $1")
         await self.bot.pool.execute(sql, channel.guild.id)
+        await self.bot.invalidation.publish("guild_config", channel.guild.id)
 
     @commands.Cog.listener()
     async def on_raw_message_delete(self, payload):
@@ -154,7 +186,7 @@ class PushBoard(commands.Cog):
         if payload.message_id in self._to_be_deleted:
             self._to_be_deleted.discard(payload.message_id)
             return
-        self.get_message.invalidate(self, payload.message_id)
+        await self.bot.invalidation.publish("message", payload.message_id)
         message = await self.safe_delete(message_id=payload.message_id, delete_message=False)
         if message:
             await self.new_pushboard_message(payload.guild_id)
@@ -168,21 +200,21 @@ class PushBoard(commands.Cog):
             if n in self._to_be_deleted:
                 self._to_be_deleted.discard(n)
                 continue
-            self.get_message.invalidate(self, n)
+            await self.bot.invalidation.publish("message", n)
             message = await self.safe_delete(message_id=n, delete_message=False)
             if message:
                 await self.new_pushboard_message(payload.guild_id)
 
     async def on_player_trophies_change(self, old_trophies, new_trophies, player):
-        trophy_change = new_trophies - old_trophies
         async with self._batch_lock:
             self._data_batch.append({"player_tag": player.tag,
                                      "player_name": player.name,
                                      "clan_tag": player.clan.tag,
                                      "clan_name": player.clan.name,
-                                     "trophy_change": trophy_change,
-                                     "time_stamp": datetime.utcnow().isoformat()})
+                                     "trophies": new_trophies,
+                                     "time_stamp": polled_at(player).isoformat()})
             self._clan_events.add(player.clan.tag)
+            BUFFER_DEPTH.set(len(self._data_batch), cog="PushBoard")
 
     async def get_updates_messages(self, guild_id, number_of_msg=None):
         guild_config = await self.get_guild_config(guild_id)
@@ -206,20 +238,17 @@ class PushBoard(commands.Cog):
             return
         if not guild_config.pushboard:
             return
-        sql = "SELECT DISTINCT clan_tag FROM clans WHERE guild_id = $1"
-        fetch = await self.bot.pool.fetch(sql, guild_id)
-        clans = await self.bot.coc.get_clans((n[0] for n in fetch)).flatten()
+        fetch = await self.bot.db.fetch("guild_clan_tags", guild_id)
+        clans = await self.bot.get_clans(n[0] for n in fetch)
         players = []
         for n in clans:
+            if await self.bot.players.sync_roster(self.bot.db, n):
+                await self.bot.invalidation.publish("players", n.tag, local=False)
             players.extend(p for p in n.itermembers)
-        sql = ("SELECT player_tag, current_trophies, current_attack_wins - starting_attack_wins AS attacks "
-               "FROM players "
-               "WHERE player_tag = ANY($1::TEXT[]) "
-               "ORDER BY current_trophies "
-               "LIMIT 100")
-        fetch = await self.bot.pool.fetch(sql, [n.tag for n in players])
+        fetch = await self.bot.db.fetch("leaderboard_players", [n.tag for n in players])
         db_players = [DatabasePlayer(bot=self.bot, record=n) for n in fetch]
-        players = {n.tag: n for n in players if n.tag in set(x.player_tag for x in db_players)}
+        db_tags = set(x.player_tag for x in db_players)
+        players = {n.tag: n for n in players if n.tag in db_tags}
         message_count = math.ceil(len(db_players) / 20)
         messages = await self.get_updates_messages(guild_id, number_of_msg=message_count)
         if not messages:
@@ -247,7 +276,7 @@ class PushBoard(commands.Cog):
                          icon_url=guild_config.icon_url or "https://cdn.discordapp.com/emojis/"
                                                            "592028799768592405.png?v=1")
             e.set_footer(text="Last Updated")
-            await v.edit(embed=e, content=None)
+            await self.edit_message(v, embed=e)
 
     @commands.group(invoke_without_command=True)
     @checks.manage_guild()
@@ -286,6 +315,7 @@ class PushBoard(commands.Cog):
         await ctx.db.execute(sql, msg.id, ctx.guild.id, channel.id)
         sql = "UPDATE guilds SET updates_channel_id = $1, updates_toggle = True WHERE guild_id = $2"
         await ctx.db.execute(sql, channel.id, ctx.guild.id)
+        await self.bot.invalidation.publish("guild_config", ctx.guild.id)
         await ctx.send(f"pushboard channel created: {channel.mention}")
         await ctx.invoke(self.pushboard_edit)
 
@@ -318,6 +348,7 @@ class PushBoard(commands.Cog):
         def check(r, u):
             return str(r) in reactions and u.id == ctx.author.id and r.message.id == msg.id
 
+        await ctx.release_for_input()
         try:
             r,u = await self.bot.wait_for("reaction_add", check=check, timeout=60.0)
         except asyncio.TimeoutError:
@@ -326,7 +357,7 @@ class PushBoard(commands.Cog):
         await ctx.db.execute(sql, reactions.index(str(r)) + 1, ctx.guild.id)
         await ctx.confirm()
         await ctx.send("All done. Thank you!")
-        self.get_guild_config.invalidate(self, ctx.guild.id)
+        await self.bot.invalidation.publish("guild_config", ctx.guild.id)
 
     @pushboard.command(name="icon")
     async def pushboard_icon(self, ctx, *, url: str = None):
@@ -339,7 +370,7 @@ class PushBoard(commands.Cog):
         sql = "UPDATE guilds SET icon_url = $1 WHERE guild_id = $2"
         await ctx.db.execute(sql, url, ctx.guild.id)
         await ctx.confirm()
-        self.get_guild_config.invalidate(self, ctx.guild.id)
+        await self.bot.invalidation.publish("guild_config", ctx.guild.id)
 
     @pushboard.command(name="title")
     async def pushboard_title(self, ctx, *, title: str = None):
@@ -347,7 +378,7 @@ class PushBoard(commands.Cog):
         sql = "UPDATE guilds SET pushboard_title = $1 WHERE guild_id = $2"
         await ctx.db.execute(sql, title, ctx.guild.id)
         await ctx.confirm()
-        self.get_guild_config.invalidate(self, ctx.guild.id)
+        await self.bot.invalidation.publish("guild_config", ctx.guild.id)
 
     @pushboard.command(name="info")
     async def pushboard_info(self, ctx):
@@ -371,6 +371,9 @@ class Admin(commands.Cog):
         if is_multistatement:
             # fetch does not support multiple statements
             strategy = ctx.db.execute
+        elif query.lstrip().upper().startswith('SELECT') and ctx._db is None:
+            # plain reads don't need to compete with the flush loops for the primary
+            strategy = self.bot.db.reader().fetch
         else:
             strategy = ctx.db.fetch
 
@@ -423,6 +426,134 @@ class Admin(commands.Cog):
         else:
             await ctx.send(fmt)
 
+    @commands.command(hidden=True)
+    async def cache_stats(self, ctx, *, name: str = None):
+        """Shows hit/miss/eviction statistics for every cached function."""
+        from .utils import cache
+        from .utils.formats import TabularData
+
+        stats = cache.all_stats()
+        if name:
+            stats = [s for s in stats if name.lower() in s.name.lower()]
+        if not stats:
+            return await ctx.send('No cached functions found.')
+
+        table = TabularData()
+        table.set_columns(['Function', 'Strategy', 'Hits', 'Misses', 'Hit %', 'Evicted',
+                           'Size', 'In flight', 'Avg load', 'Max load'])
+        table.add_rows(['.'.join(s.name.split('.')[-2:]), s.strategy,
+                        s.hits, s.misses, f'{s.hit_rate * 100:.1f}', s.evictions, s.size, s.in_flight,
+                        f'{s.average_load_time * 1000:.2f}ms', f'{s.max_load_time * 1000:.2f}ms']
+                       for s in stats)
+        render = table.render()
+
+        fmt = f'```\n{render}\n```'
+        if len(fmt) > 2000:
+            fp = io.BytesIO(fmt.encode('utf-8'))
+            await ctx.send('Too many results...', file=discord.File(fp, 'cache_stats.txt'))
+        else:
+            await ctx.send(fmt)
+
+    @commands.command(hidden=True)
+    async def query_stats(self, ctx, sort: str = 'total'):
+        """Shows the most expensive statements. Sort by total, avg, max, calls or slow, or reset."""
+        from .utils import db
+        from .utils.formats import TabularData
+
+        if sort == 'reset':
+            db.statement_stats.clear()
+            return await ctx.send('Query statistics reset.')
+        keys = {
+            'total': lambda s: s.total_time,
+            'avg': lambda s: s.average_time,
+            'max': lambda s: s.max_time,
+            'calls': lambda s: s.calls,
+            'slow': lambda s: s.slow,
+        }
+        if sort not in keys:
+            return await ctx.send(f'Sort by one of {", ".join(keys)}, or reset.')
+        stats = sorted(db.statement_stats.values(), key=keys[sort], reverse=True)[:15]
+        if not stats:
+            return await ctx.send('No queries recorded yet.')
+
+        table = TabularData()
+        table.set_columns(['Statement', 'Calls', 'Total', 'Avg', 'Max', 'Slow'])
+        table.add_rows([textwrap.shorten(s.statement, 60), s.calls, f'{s.total_time:.2f}s',
+                        f'{s.average_time * 1000:.2f}ms', f'{s.max_time * 1000:.2f}ms', s.slow]
+                       for s in stats)
+        render = table.render()
+
+        fmt = f'```\n{render}\n```\n*Slow query threshold: {db.slow_query_seconds * 1000:.0f}ms*'
+        if len(fmt) > 2000:
+            fp = io.BytesIO(fmt.encode('utf-8'))
+            await ctx.send('Too many results...', file=discord.File(fp, 'query_stats.txt'))
+        else:
+            await ctx.send(fmt)
+
+    @commands.command(hidden=True)
+    async def poll_stats(self, ctx):
+        """Shows how the player poller keeps up: sweep time, request rate, throttling and staleness."""
+        from .utils import cocapi, polling
+        from .utils.formats import TabularData
+
+        if self.bot.workers is not None:
+            return await ctx.send(f'Polling runs in {self.bot.workers.count} worker processes, '
+                                  f'see their metrics endpoints.')
+        poller = self.bot.poller
+        stats = poller.stats
+        ages = poller.staleness()
+        waits, wait_total = cocapi.THROTTLE_WAIT.summary()
+
+        table = TabularData()
+        table.set_columns(['Stat', 'Value'])
+        table.add_rows([
+            ['Players registered', len(self.bot.players)],
+            ['Players scheduled', len(poller)],
+            ['Polls', stats.polls],
+            ['Trophy changes', stats.changes],
+            ['Errors', stats.errors],
+            ['429 responses', cocapi.THROTTLED.total()],
+            ['Requests/sec', f'{poller.requests_per_second:.1f} of {poller.budget:g}'],
+            ['Budget wait', f'{stats.budget_wait:.1f}s'],
+            ['Throttle wait', f'{wait_total:.1f}s over {waits} requests'],
+            ['Sweeps', stats.sweeps],
+            ['Last sweep', f'{stats.last_sweep:.1f}s' if stats.last_sweep is not None else '-'],
+        ])
+        for q in polling.STALENESS_QUANTILES:
+            label = 'max' if q == 100 else f'p{q}'
+            table.add_row([f'Staleness {label}', f'{polling.percentile(ages, q):.1f}s' if ages else '-'])
+        await ctx.send(f'```\n{table.render()}\n```')
+
+    @commands.command(hidden=True)
+    async def explain(self, ctx, min_rows: int = 10000):
+        """Plans every read statement in the catalog and flags seq scans over large tables.
+
+        This is a plain EXPLAIN, so nothing runs against the live tables. Use
+        ``python -m cogs.utils.migrations explain`` on a seeded copy for timings.
+        """
+        from .utils import migrations
+        from .utils.formats import TabularData
+
+        async with ctx.typing():
+            async with self.bot.db.reader().acquire() as connection:
+                try:
+                    results = await migrations.explain_catalog(connection, min_rows=min_rows, analyze=False)
+                except Exception:
+                    return await ctx.send(f'```py\n{traceback.format_exc()}\n```')
+
+        table = TabularData()
+        table.set_columns(['Statement', 'Cost', 'Seq scans'])
+        table.add_rows([r.name, f'{r.cost:.0f}', ', '.join(r.seq_scans) if not r.ok else '-'] for r in results)
+        render = table.render()
+        failed = sum(not r.ok for r in results)
+
+        fmt = f'```\n{render}\n```\n*{failed} of {len(results)} statements scan large tables*'
+        if len(fmt) > 2000:
+            fp = io.BytesIO(fmt.encode('utf-8'))
+            await ctx.send('Too many results...', file=discord.File(fp, 'explain.txt'))
+        else:
+            await ctx.send(fmt)
+
     @commands.command(hidden=True)
     async def sudo(self, ctx, channel: Optional[GlobalChannel], who: discord.User, *, command: str):
         """Run a command as another user optionally in another channel."""
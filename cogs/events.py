@@ -10,10 +10,14 @@ from datetime import datetime
 import discord
 from discord.ext import commands, tasks
 from cogs.utils.converters import ClanConverter, PlayerConverter
-from cogs.utils import formatters, checks
+from cogs.utils import formatters, checks, cache
 from cogs.utils.db_objects import DatabaseEvent, DatabasePushEvent
+from cogs.utils.metrics import registry, BUFFER_DEPTH, FLUSH_ROWS, FLUSH_SECONDS
+from cogs.utils.workers import polled_at
 from config import emojis
 
+REPORT_SECONDS = registry.histogram('pushbot_report_loop_seconds', 'Duration of the Events bulk report loop')
+
 
 class Events(commands.Cog):
     """Pull information on changes in trophy count for specified clans"""
@@ -27,7 +31,11 @@ class Events(commands.Cog):
         self.report_task.start()
         self.check_for_timers_task = self.bot.loop.create_task(self.check_for_timers())
         self.bot.coc.add_events(self.on_player_trophies_change)
-        self.channel_config_cache = {}
+        self.bot.poll_queue.register_buffer("Events")
+        # channel_id -> DatabasePushEvent, or None for channels known to have no event
+        self.channel_config_cache = cache.ExpiringCache(seconds=3600, maxsize=10000)
+        self.preload_task = self.bot.loop.create_task(self.preload_channel_configs())
+        self.bot.invalidation.register("channel_config", self.on_channel_config_invalidated)
 
     async def cog_command_error(self, ctx, error):
         self.bot.logger.debug(f"Command Error in {self.__class__.__name__}\n{error}")
@@ -37,7 +45,10 @@ class Events(commands.Cog):
         self.report_task.cancel()
         self.batch_insert_loop.cancel()
         self.check_for_timers_task.cancel()
+        self.preload_task.cancel()
+        self.bot.invalidation.unregister("channel_config")
         self.bot.coc.remove_events(self.on_player_trophies_change)
+        self.bot.poll_queue.unregister_buffer("Events")
 
     @tasks.loop(seconds=30)
     async def batch_insert_loop(self):
@@ -45,17 +56,17 @@ class Events(commands.Cog):
             await self.bulk_insert()
 
     async def bulk_insert(self):
-        sql = ("INSERT INTO coc_events (player_tag, player_name, clan_tag, clan_name, trophy_change, time_stamp) "
-               "SELECT json.player_tag, json.player_name, json.clan_tag, json.clan_name, json.trophy_change, "
-               "json.time_stamp FROM jsonb_to_recordset($1::jsonb) "
-               "AS json(player_tag TEXT, player_name TEXT, clan_tag TEXT, clan_name TEXT, trophy_change INTEGER, "
-               "time_stamp TIMESTAMP)")
+        start = time.perf_counter()
         if self._batch_data:
-            await self.bot.pool.execute(sql, self._batch_data)
+            await self.bot.db.execute("insert_coc_events", self._batch_data)
             total = len(self._batch_data)
             if total > 1:
                 self.bot.logger.info(f"Registered {total} events to the database.")
             self._batch_data.clear()
+            BUFFER_DEPTH.set(0, cog="Events")
+            FLUSH_ROWS.observe(total, cog="Events")
+            FLUSH_SECONDS.observe(time.perf_counter() - start, cog="Events")
+        self.bot.poll_queue.flushed("Events")
 
     def dispatch_log(self, channel_id, interval, fmt):
         seconds = interval.total_seconds()
@@ -78,27 +89,23 @@ class Events(commands.Cog):
         start = time.perf_counter()
         async with self._batch_lock:
             await self.bulk_report()
-        self.bot.logger.info(f"Report loop took {(time.perf_counter() - start) * 1000} ms")
+        elapsed = time.perf_counter() - start
+        REPORT_SECONDS.observe(elapsed)
+        self.bot.logger.info(f"Report loop took {elapsed * 1000} ms")
 
     async def bulk_report(self):
-        sql = ("SELECT DISTINCT channel_id FROM events e "
-               "INNER JOIN clans c ON e.event_id = c.event_id "
-               "INNER JOIN coc_events ce ON c.clan_tag = ce.clan_tag AND ce.reported")
-        channel_ids = await self.bot.pool.fetch(sql)
-        sql = ("SELECT * FROM coc_events ce "
-               "INNER JOIN clans c ON ce.clan_tag = c.clan_tag "
-               "INNER JOIN events e ON c.event_id = e.event.id "
-               "WHERE e.channel_id = $1 "
-               "AND ce.reported = False "
-               "ORDER BY e.event_id, ce.time_stamp DESC")
+        # mark_reported runs on the primary, so anything a replica hasn't seen yet would be lost
+        channel_ids = await self.bot.db.fetch("unreported_channels", fresh=True)
+        await self.load_channel_configs([n[0] for n in channel_ids
+                                         if n[0] not in self.channel_config_cache])
         for channel_id in channel_ids:
-            channel_config = await self.bot.get_channel_config(channel_id[0])
+            channel_config = self.channel_config_cache.get(channel_id[0])
             if not channel_config:
                 continue
             if not channel_config.log_toggle:
                 continue
             events = [DatabaseEvent(bot=self.bot, record=event) for event in
-                      await self.bot.pool.fetch(sql, channel_id[0])]
+                      await self.bot.db.fetch("unreported_events", channel_id[0], fresh=True)]
             messages = []
             for event in events:
                 clan_name = await self.bot.pushboard.get_clan_name(channel_config.guild_id,
@@ -113,10 +120,7 @@ class Events(commands.Cog):
             self.bot.logger.info("Dispatched logs for {} (guild {})".format(channel_config.channel or "Not Found",
                                                                             channel_config.guild or "No guild"))
         # TODO How does trophy change in events translate to currentTrophies in players?
-        sql = ("UPDATE events "
-               "SET reported = True "
-               "WHERE reported = False")
-        removed = await self.bot.pool.execute(sql)
+        removed = await self.bot.db.execute("mark_reported")
         self.bot.logger.info(f"Removed events from the database. Status Code {removed}")
 
     async def short_timer(self, seconds, channel_id, fmt):
@@ -127,8 +131,7 @@ class Events(commands.Cog):
     async def check_for_timers(self):
         try:
             while not self.bot.is_closed():
-                sql = "SELECT * FROM log_timers ORDER BY expires LIMIT 1"
-                timer = await self.bot.pool.fetchrow(sql)
+                timer = await self.bot.db.fetchrow("next_log_timer")
                 if not timer:
                     continue
                 now = datetime.utcnow()
@@ -138,8 +141,7 @@ class Events(commands.Cog):
                 await self.bot.channel_log(timer["channel_id"], timer["fmt"], embed=False)
                 self.bot.logger.info(f"Sent a log to channel ID: {timer['channel_id']} which "
                                      f"had been saved to the database.")
-                sql = "DELETE FROM log_timers WHERE id = $1"
-                await self.bot.pool.execute(sql, timer["timer_id"])
+                await self.bot.db.execute("delete_log_timer", timer["id"])
         except asyncio.CancelledError:
             raise
         except (OSError, discord.ConnectionClosed, asyncpg.PostgresConnectionError):
@@ -147,8 +149,7 @@ class Events(commands.Cog):
             self.create_new_timer_task = self.bot.loop.create_task(self.check_for_timers())
 
     async def create_new_timer(self, channel_id, fmt, expires):
-        sql = "INSERT INTO log_timers (channel_id, fmt, expires) VALUES ($1, $2, $3)"
-        await self.bot.pool.execute(sql, channel_id, fmt, expires)
+        await self.bot.db.execute("insert_log_timer", channel_id, fmt, expires)
 
     async def on_player_trophies_change(self, old_trophies, new_trophies, player):
         trophy_change = new_trophies - old_trophies
@@ -158,24 +159,58 @@ class Events(commands.Cog):
                                      "clan_tag": player.clan.tag,
                                      "clan_name": player.clan.name,
                                      "trophy_change": trophy_change,
-                                     "time_stamp": datetime.utcnow().isoformat()})
-
-    async def get_channel_config(self,  channel_id):
-        config = self.channel_config_cache[channel_id]
-        if config:
-            return config
-        sql = ("SELECT event_id, guild_id, event_name, channel_id, log_interval, log_toggle FROM events "
-               "WHERE channel_id = $1")
-        fetch = await self.bot.pool.fetchrow(sql, channel_id)
-        if not fetch:
-            return None
-        push_event = DatabasePushEvent(bot=self.bot, record=fetch)
+                                     "time_stamp": polled_at(player).isoformat(),
+                                     "poll_event_id": getattr(player, "poll_event_id", None)})
+            BUFFER_DEPTH.set(len(self._batch_data), cog="Events")
+
+    async def get_channel_config(self, channel_id):
+        try:
+            return self.channel_config_cache[channel_id]
+        except KeyError:
+            pass
+        fetch = await self.bot.db.fetchrow("channel_config", channel_id, fresh=True)
+        push_event = fetch and DatabasePushEvent(bot=self.bot, record=fetch)
         self.channel_config_cache[channel_id] = push_event
         return push_event
 
+    async def load_channel_configs(self, channel_ids=None):
+        """Loads channel configs into the cache with a single query.
+
+        If ``channel_ids`` is ``None`` every event with a log channel is loaded,
+        otherwise channels without an event are cached as ``None``.
+        """
+        if channel_ids is None:
+            fetch = await self.bot.db.fetch("all_channel_configs", fresh=True)
+        elif not channel_ids:
+            return
+        else:
+            fetch = await self.bot.db.fetch("channel_configs", channel_ids, fresh=True)
+            for channel_id in channel_ids:
+                self.channel_config_cache[channel_id] = None
+        for record in fetch:
+            self.channel_config_cache[record['channel_id']] = DatabasePushEvent(bot=self.bot, record=record)
+
+    async def preload_channel_configs(self):
+        await self.bot.wait_until_ready()
+        await self.load_channel_configs()
+
     def invalidate_channel_config(self, channel_id):
         self.channel_config_cache.pop(channel_id, None)
 
+    def on_channel_config_invalidated(self, channel_id):
+        # bulk_report reloads whatever is missing in one query
+        if channel_id is None:
+            self.channel_config_cache.clear()
+        else:
+            self.invalidate_channel_config(channel_id)
+
+    async def refresh_channel_configs(self, *channel_ids):
+        """Reloads the given channels here so the report loop never misses on them,
+        and invalidates them in every other process."""
+        for channel_id in channel_ids:
+            await self.bot.invalidation.publish("channel_config", channel_id)
+        await self.load_channel_configs(list(channel_ids))
+
     @commands.group(invoke_without_subcommand=True)
     @checks.manage_guild()
     async def log(self, ctx):
@@ -224,7 +259,7 @@ class Events(commands.Cog):
         fmt = "\n".join(n[0] for n in fetch)
         self.bot.logger.info(f"Set log interval to {minutes} minutes for {fmt}.")
         await ctx.send(f"Set log interval to {minutes} minutes for {fmt}.")
-        self.invalidate_channel_config(channel.id)
+        await self.refresh_channel_configs(channel.id)
 
     @log.command(name="create")
     async def log_create(self, ctx, channel: typing.Optional[discord.TextChannel] = None):
@@ -233,11 +268,12 @@ class Events(commands.Cog):
             channel = ctx.channel
         if not (channel.permissions_for(ctx.me).send_messages or channel.permissions_for(ctx.me).read_messages):
             return await ctx.send("I need permission to read and send messages here!")
-        sql = ("UPDATE events "
+        sql = ("UPDATE events e "
                "SET channel_id = $1, "
                "log_toggle = True "
-               "WHERE guild_id = $2 "
-               "RETURNING event_name")
+               "FROM (SELECT event_id, channel_id FROM events WHERE guild_id = $2) old "
+               "WHERE e.event_id = old.event_id "
+               "RETURNING e.event_name, old.channel_id")
         fetch = await ctx.db.fetch(sql, channel.id, ctx.guild.id)
         if not fetch:
             return await ctx.send("Please add your event using :trophy:add_event")
@@ -245,7 +281,7 @@ class Events(commands.Cog):
         await ctx.send(F"Log channel has been set to {channel.mention} for {event_name} "
                        F"and logging is enabled.")
         await ctx.confirm()
-        self.invalidate_channel_config(channel.id)
+        await self.refresh_channel_configs(channel.id, *set(n[1] for n in fetch if n[1]))
 
     @log.command(name="toggle")
     async def log_toggle(self, ctx, channel: discord.TextChannel = None):
@@ -266,7 +302,7 @@ class Events(commands.Cog):
         event_name = "\n".join(n[0] for n in fetch)
         await ctx.send(F"Logging has been {'enabled' if toggle else 'disabled'} for {event_name}")
         await ctx.confirm()
-        self.invalidate_channel_config(channel.id)
+        await self.refresh_channel_configs(channel.id)
 
     @commands.group(invoke_without_command=True)
     async def recent(self, ctx, limit: typing.Optional[int] = 20, *,
@@ -281,20 +317,13 @@ class Events(commands.Cog):
         elif isinstance(arg, coc.BasicPlayer):
             await ctx.invoke(self.recent_player, player=arg, limit=limit)
         elif isinstance(arg, coc.Clan):
-            await ctx.inoke(self.recent_clan, clan=arg, limit=limit)
+            await ctx.invoke(self.recent_clan, clan=arg, limit=limit)
         else:
             await ctx.send("That's not going to work for me. Please try again with a valid player or clan.")
 
     @recent.command(name="recent_all", hidden=True)
     async def recent_all(self, ctx, limit: int = None):
-        sql = ("SELECT player_name, clan_name, trophy_change, time_stamp "
-               "FROM coc_events"
-               "WHERE clan_tag IN "
-               "(SELECT clan_tag FROM clans WHERE event_id IN"
-               "(SELECT event_id from events WHERE guild_id = $1)) "
-               "ORDER BY time_stamp DESC"
-               "LIMIT $2")
-        fetch = await ctx.db.fetch(sql, ctx.guild.id, limit)
+        fetch = await self.bot.db.fetch("recent_guild", ctx.guild.id, limit)
         if not fetch:
             return await ctx.send("No trophy changes found. Please ensure you have enabled "
                                   "logging and have set up your event for this Discord server.")
@@ -306,12 +335,7 @@ class Events(commands.Cog):
     @recent.command(name="player", hidden=True)
     async def recent_player(self, ctx, limit: typing.Optional[int] = 20, *,
                             player: PlayerConverter):
-        sql = ("SELECT player_name, clan_name, trophy_change, time_stamp  "
-               "FROM coc_events "
-               "WHERE player_tag = $1 "
-               "ORDER BY time_stamp DESC"
-               "LIMIT $2")
-        fetch = await ctx.db.fetch(sql, player.tag, limit)
+        fetch = await self.bot.db.fetch("recent_player", player.tag, limit)
         if not fetch:
             return await ctx.send(f"{player.name} ({player.clan}) is not in the event. "
                                   f"Use :trophy:add_player to add them.")
@@ -320,14 +344,9 @@ class Events(commands.Cog):
         p = formatters.EventsPaginator(ctx, data=fetch, title=title, page_count=num_pages)
         await p.paginate()
 
-    @recent.commands(name="clan", hidden=True)
+    @recent.command(name="clan", hidden=True)
     async def recent_clan(self, ctx, limit: typing.Optional[int] = 20, *, clans: ClanConverter):
-        sql = ("SELECT player_name, clan_name, trophy_change, time_stamp "
-               "FROM coc_events "
-               "WHERE clan_tag = ANY($1::TEXT[]) "
-               "ORDER BY time_stamp DESC "
-               "LIMIT $2")
-        fetch = ctx.db.fetch(sql, list(set(n.tag for n in clans)), limit)
+        fetch = await self.bot.db.fetch("recent_clans", list(set(n.tag for n in clans)), limit)
         if not fetch:
             return await ctx.send("No events found for the clan(s) provided.")
         title = f"Recent Trophy Changes for {', '.join(n.name for n in clans)}"
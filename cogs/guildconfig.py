@@ -52,10 +52,17 @@ class GuildConfig(commands.Cog):
                 clan = await ctx.coc.get_clan(tag)
             except coc.NotFound:
                 raise commands.BadArgument("I can't find a clan with the tag: {tag}")
-            sql = "INSERT INTO clans (clan_tag, clan_name, event_id) VALUES ($1, $2)"
-            await ctx.db.execute(sql, clan.tag, clan.name, guild_event)
-            await ctx.send(f"{clan.name} ({clan.tag}) added to the database. Players will be added to the database "
-                           f"when the event starts.")
+            members = [{"player_tag": n.tag, "player_name": n.name, "clan_tag": clan.tag, "trophies": n.trophies}
+                       for n in clan.itermembers]
+            # the clan, its players and the notify commit together
+            async with ctx.acquire():
+                async with ctx.db.transaction():
+                    sql = "INSERT INTO clans (clan_tag, clan_name, event_id, guild_id) VALUES ($1, $2, $3, $4)"
+                    await ctx.db.execute(sql, clan.tag, clan.name, guild_event, ctx.guild.id)
+                    added = await self.bot.db.fetch("insert_players", members, connection=ctx.db)
+                    await self.bot.invalidation.publish("players", clan.tag, connection=ctx.db, local=False)
+            self.bot.players.add_many(added)
+            await ctx.send(f"{clan.name} ({clan.tag}) added to the database with {len(added)} new players.")
 
     @commands.command(name="remove", aliases=["removeclan", "remove_clan"])
     @checks.manage_guild()
@@ -63,8 +70,9 @@ class GuildConfig(commands.Cog):
         """Remove clan (and its players) from the database."""
         for tag in tags:
             tag = coc.utils.correct_tag(tag)
-            sql = "SELECT event_id FROM clans WHERE clan_tag = $1 ORDER BY event_start_time DESC"
-            event_ids = ctx.db.fetch(sql, tag)
+            sql = ("SELECT c.event_id FROM clans c INNER JOIN events e ON e.event_id = c.event_id "
+                   "WHERE c.clan_tag = $1 ORDER BY e.event_start_time DESC")
+            event_ids = await ctx.db.fetch(sql, tag)
             if len(event_ids) == 0:
                 try:
                     clan = await ctx.coc.get_clan(tag)
@@ -72,10 +80,13 @@ class GuildConfig(commands.Cog):
                 except coc.NotFound:
                     raise commands.BadArgument(f"I can't find a clan with the tag: {tag}")
             if len(event_ids) == 1:
-                sql = "DELETE FROM players WHERE clan_tag = $1"
-                await ctx.db.execute(sql, tag)
-                sql = "DELETE FROM clans WHERE clan_tag = $1"
-                await ctx.db.execute(sql, tag)
+                async with ctx.acquire():
+                    async with ctx.db.transaction():
+                        removed = await self.bot.db.fetch("delete_clan_players", tag, connection=ctx.db)
+                        sql = "DELETE FROM clans WHERE clan_tag = $1"
+                        await ctx.db.execute(sql, tag)
+                        await self.bot.invalidation.publish("players", tag, connection=ctx.db, local=False)
+                self.bot.players.discard_many(n[0] for n in removed)
                 clan = await ctx.coc.get_clan(tag)
                 await ctx.send(f"{clan.name} ({clan.tag}) has been removed from your event.")
                 return
@@ -1,125 +1,483 @@
 import inspect
 import asyncio
 import enum
+import functools
+import sys
 import time
+import weakref
 
+from collections import OrderedDict
 from functools import wraps
 
+from loguru import logger
 from lru import LRU
 
-def _wrap_and_store_coroutine(cache, key, coro):
-    async def func():
-        value = await coro
-        cache[key] = value
-        return value
-    return func()
+async def _wait_for_load(future):
+    # shielded so a cancelled caller doesn't cancel the load for everyone else
+    return await asyncio.shield(future)
 
 def _wrap_new_coroutine(value):
     async def new_coroutine():
         return value
     return new_coroutine()
 
-class ExpiringCache(dict):
-    def __init__(self, seconds):
+class ExpiringCache:
+    """A mapping whose entries expire ``seconds`` after they were written.
+
+    Entries are kept in write order, which with a fixed TTL is also expiry
+    order, so every expired entry sits at the front. Reads expire their own
+    key lazily and writes drop a couple of expired entries from the front,
+    so each entry is removed exactly once and no operation scans the cache.
+    :func:`sweep_expired` cleans up caches that are rarely written to.
+
+    ``len()`` may include expired entries that have not been swept yet.
+    """
+
+    def __init__(self, seconds, maxsize=None, *, on_evict=None):
         self.__ttl = seconds
-        super().__init__()
+        self.__maxsize = maxsize
+        self._data = OrderedDict()
+        self.on_evict = on_evict
+        self.expirations = 0
+        self.evictions = 0
+        _expiring_caches.add(self)
+
+    def _discard(self, key):
+        del self._data[key]
+        if self.on_evict is not None:
+            self.on_evict(key)
 
-    def __verify_cache_integrity(self):
-        # Have to do this in two steps...
-        current_time = time.monotonic()
-        to_remove = [k for (k, (v, t)) in self.items() if current_time > (t + self.__ttl)]
-        for k in to_remove:
-            del self[k]
+    def sweep(self, limit=None):
+        """Removes up to ``limit`` expired entries and returns how many were removed."""
+        now = time.monotonic()
+        data = self._data
+        removed = 0
+        while data and (limit is None or removed < limit):
+            key, (value, expires) = next(iter(data.items()))
+            if expires > now:
+                break
+            self._discard(key)
+            removed += 1
+        self.expirations += removed
+        return removed
 
     def __getitem__(self, key):
-        self.__verify_cache_integrity()
-        return super().__getitem__(key)
+        value, expires = self._data[key]
+        if expires <= time.monotonic():
+            self._discard(key)
+            self.expirations += 1
+            raise KeyError(key)
+        return value
 
     def __setitem__(self, key, value):
-        super().__setitem__(key, (value, time.monotonic()))
+        data = self._data
+        # re-inserting moves the key to the back so the front always expires first
+        data.pop(key, None)
+        self.sweep(2)
+        if self.__maxsize is not None and len(data) >= self.__maxsize:
+            self._discard(next(iter(data)))
+            self.evictions += 1
+        data[key] = (value, time.monotonic() + self.__ttl)
+
+    def __delitem__(self, key):
+        del self._data[key]
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __len__(self):
+        return len(self._data)
+
+    def __iter__(self):
+        return iter(list(self._data))
+
+    def keys(self):
+        return list(self._data)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self._data[key]
+        return value
+
+    def clear(self):
+        self._data.clear()
+
+
+_expiring_caches = weakref.WeakSet()
+
+
+async def sweep_expired(interval=60.0, batch=1000):
+    """Periodically sweeps every :class:`ExpiringCache` in batches of ``batch``,
+    yielding to the event loop between batches."""
+    while True:
+        await asyncio.sleep(interval)
+        for expiring in list(_expiring_caches):
+            while expiring.sweep(batch) == batch:
+                await asyncio.sleep(0)
 
 class Strategy(enum.Enum):
     lru = 1
     raw = 2
     timed = 3
+    revalidate = 4
+
+class CacheStats:
+    """Counters kept for every cached function.
+
+    ``evictions`` counts entries dropped by the cache itself, which for
+    ``Strategy.timed`` includes expired entries.
+    """
+    __slots__ = ('name', 'strategy', 'hits', 'misses', 'coalesced', 'evictions', 'loads',
+                 'load_time', 'max_load_time', 'size', 'in_flight', 'bytes')
+
+    def __init__(self, name, strategy):
+        self.name = name
+        self.strategy = strategy
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.loads = 0
+        self.load_time = 0.0
+        self.max_load_time = 0.0
+        self.size = 0
+        self.in_flight = 0
+        self.bytes = 0
+
+    def record_load(self, seconds):
+        self.loads += 1
+        self.load_time += seconds
+        if seconds > self.max_load_time:
+            self.max_load_time = seconds
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    @property
+    def average_load_time(self):
+        return self.load_time / self.loads if self.loads else 0.0
+
+
+# qualified function name -> wrapper, so reloaded cogs replace their old entries
+cached_functions = {}
+
+
+def all_stats():
+    """Returns the :class:`CacheStats` of every cached function."""
+    return [wrapper.get_stats() for wrapper in cached_functions.values()]
+
+
+def approximate_size(obj):
+    """The size of ``obj`` plus its direct attributes, in bytes."""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (tuple, list)):
+        return size + sum(sys.getsizeof(o) for o in obj)
+    for name in getattr(obj.__class__, '__slots__', ()):
+        size += sys.getsizeof(getattr(obj, name, None))
+    return size + sum(sys.getsizeof(o) for o in getattr(obj, '__dict__', {}).values())
+
+
+class SizedLRU:
+    """An LRU bounded by the approximate memory of its entries rather than their count.
+
+    Registered in :data:`cached_functions` under ``name`` so it shows up
+    alongside the decorated caches.
+    """
+
+    def __init__(self, name, max_bytes, *, sizeof=approximate_size):
+        self.max_bytes = max_bytes
+        self.footprint = 0
+        self.sizeof = sizeof
+        self._data = OrderedDict()
+        self._stats = CacheStats(name, 'sized')
+        cached_functions[name] = self
+
+    def get(self, key, default=None):
+        try:
+            value, size = self._data[key]
+        except KeyError:
+            self._stats.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self._stats.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        self.pop(key)
+        size = self.sizeof(key) + self.sizeof(value)
+        self._data[key] = (value, size)
+        self.footprint += size
+        while self.footprint > self.max_bytes and len(self._data) > 1:
+            old, (_, old_size) = self._data.popitem(last=False)
+            self.footprint -= old_size
+            self._stats.evictions += 1
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def pop(self, key, default=None):
+        try:
+            value, size = self._data.pop(key)
+        except KeyError:
+            return default
+        self.footprint -= size
+        return value
+
+    def clear(self):
+        self._data.clear()
+        self.footprint = 0
+
+    def get_stats(self):
+        self._stats.size = len(self._data)
+        self._stats.bytes = self.footprint
+        return self._stats
+
+
+_primitives = (int, str, bytes, float, bool, type(None))
+
+
+def _key_part(o):
+    cls = o.__class__
+    if cls in _primitives:
+        return o
+    # we don't care which instance 'self' is, only what it is
+    if cls.__repr__ is object.__repr__:
+        return cls
+    # identity-hashed or unhashable objects are keyed on their repr, which is
+    # what e.g. Context.__repr__ exists for
+    if cls.__hash__ is object.__hash__ or cls.__hash__ is None:
+        return repr(o)
+    return o
+
+
+def skip_self(args, kwargs):
+    """A key function for methods whose remaining arguments are already hashable,
+    e.g. ``(self, guild_id)`` is keyed on ``(guild_id,)``.
+
+    Keyword arguments are refused rather than keyed, so ``f(1)`` and
+    ``f(guild_id=1)`` can't end up as two entries that invalidate separately.
+    """
+    if kwargs:
+        raise TypeError(f'skip_self keyed caches take positional arguments only, got {", ".join(kwargs)}')
+    return args[1:]
+
+
+def cache(maxsize=128, strategy=Strategy.lru, ignore_kwargs=False, ttl=None, key=None,
+          soft_ttl=60.0, hard_ttl=3600.0):
+    """Caches the return value of a function or coroutine function.
+
+    ``Strategy.revalidate`` is an LRU for coroutine functions that serves
+    values older than ``soft_ttl`` seconds as they are while reloading them
+    in the background. Only values older than ``hard_ttl`` make the caller
+    wait for a reload.
+
+    ``invalidate`` drops an entry so the next caller waits for a fresh load.
+    ``refresh`` is the non-blocking alternative: it reloads in the background
+    straight away and callers keep getting the old value until that lands.
+
+    Concurrent misses on a coroutine function share a single load: the
+    first caller starts it and everyone else awaits the same future. If the
+    load raises, every waiter gets the exception and nothing is cached.
+
+    Keys are tuples built from the arguments. ``key`` can be passed a function
+    taking ``(args, kwargs)`` and returning a hashable key, e.g. :func:`skip_self`.
+    Every argument value is indexed so ``invalidate_containing(value)`` only
+    touches the entries that were called with ``value``.
+    """
+    key_func = key
 
-def cache(maxsize=128, strategy=Strategy.lru, ignore_kwargs=False):
     def decorator(func):
-        if strategy is Strategy.lru:
-            _internal_cache = LRU(maxsize)
-            _stats = _internal_cache.get_stats
+        revalidating = strategy is Strategy.revalidate
+        if revalidating and not asyncio.iscoroutinefunction(func):
+            raise TypeError('Strategy.revalidate can only cache coroutine functions')
+
+        _index = {}
+        _stats = CacheStats(f'{func.__module__}.{func.__qualname__}', strategy.name)
+
+        def _evicted(key):
+            _stats.evictions += 1
+            _unindex(key)
+
+        def _unindex(key):
+            for part in key:
+                try:
+                    keys = _index[part]
+                except (KeyError, TypeError):
+                    continue
+                keys.discard(key)
+                if not keys:
+                    del _index[part]
+
+        if strategy is Strategy.lru or revalidating:
+            _internal_cache = LRU(maxsize, callback=lambda key, value: _evicted(key))
         elif strategy is Strategy.raw:
             _internal_cache = {}
-            _stats = lambda: (0, 0)
         elif strategy is Strategy.timed:
-            _internal_cache = ExpiringCache(maxsize)
-            _stats = lambda: (0, 0)
+            # without a ttl, maxsize is the ttl in seconds and the cache is unbounded
+            if ttl is None:
+                _internal_cache = ExpiringCache(maxsize, on_evict=_evicted)
+            else:
+                _internal_cache = ExpiringCache(ttl, maxsize, on_evict=_evicted)
 
         def _make_key(args, kwargs):
-            # this is a bit of a cluster fuck
-            # we do care what 'self' parameter is when we __repr__ it
-            def _true_repr(o):
-                if o.__class__.__repr__ is object.__repr__:
-                    return f'<{o.__class__.__module__}.{o.__class__.__name__}>'
-                return repr(o)
-
-            key = [ f'{func.__module__}.{func.__name__}' ]
-            key.extend(_true_repr(o) for o in args)
-            if not ignore_kwargs:
+            if key_func is not None:
+                return key_func(args, kwargs)
+
+            parts = tuple([_key_part(o) for o in args])
+            if kwargs and not ignore_kwargs:
+                # note: this only really works for this use case in particular
+                # I want to pass asyncpg.Connection objects to the parameters
+                # however, I do not care what connection is passed in, so I
+                # needed a bypass.
                 for k, v in kwargs.items():
-                    # note: this only really works for this use case in particular
-                    # I want to pass asyncpg.Connection objects to the parameters
-                    # however, they use default __repr__ and I do not care what
-                    # connection is passed in, so I needed a bypass.
-                    if k == 'connection':
-                        continue
+                    if k != 'connection':
+                        parts += (k, _key_part(v))
+            return parts
+
+        def _store(key, value):
+            if revalidating:
+                _internal_cache[key] = (value, time.monotonic())
+            else:
+                _internal_cache[key] = value
+            for part in key:
+                if isinstance(part, type):
+                    continue
+                try:
+                    _index.setdefault(part, set()).add(key)
+                except TypeError:
+                    continue
+
+        # key -> future of a coroutine that is still loading its value
+        _inflight = {}
+
+        def _finish_load(key, started, background, future):
+            _stats.record_load(time.perf_counter() - started)
+            if background and not future.cancelled() and future.exception() is not None:
+                # nobody awaits a revalidation, so this is the only trace of a broken loader
+                logger.opt(exception=future.exception()).error(
+                    f"Background reload of {func.__qualname__}{key!r} failed, serving the stale value")
+            if _inflight.get(key) is not future:
+                # invalidated while loading, so the value may already be stale
+                return
+            del _inflight[key]
+            if future.cancelled():
+                return
+            if future.exception() is None:
+                _store(key, future.result())
 
-                    key.append(_true_repr(k))
-                    key.append(_true_repr(v))
+        def _load(key, awaitable, background=False):
+            future = asyncio.ensure_future(awaitable)
+            _inflight[key] = future
+            future.add_done_callback(functools.partial(_finish_load, key, time.perf_counter(), background))
+            return future
 
-            return ':'.join(key)
+        is_coroutine_function = asyncio.iscoroutinefunction(func)
 
         @wraps(func)
         def wrapper(*args, **kwargs):
             key = _make_key(args, kwargs)
             try:
                 value = _internal_cache[key]
+                if revalidating:
+                    value, loaded_at = value
+                    age = time.monotonic() - loaded_at
+                    if age >= hard_ttl:
+                        raise KeyError(key)
+                    if age >= soft_ttl and key not in _inflight:
+                        _load(key, func(*args, **kwargs), background=True)
             except KeyError:
+                _stats.misses += 1
+                try:
+                    future = _inflight[key]
+                except KeyError:
+                    pass
+                else:
+                    _stats.coalesced += 1
+                    return _wait_for_load(future)
+
+                started = time.perf_counter()
                 value = func(*args, **kwargs)
 
                 if inspect.isawaitable(value):
-                    return _wrap_and_store_coroutine(_internal_cache, key, value)
+                    return _wait_for_load(_load(key, value))
 
-                _internal_cache[key] = value
+                _stats.record_load(time.perf_counter() - started)
+                _store(key, value)
                 return value
             else:
-                if asyncio.iscoroutinefunction(func):
+                _stats.hits += 1
+                if is_coroutine_function:
                     return _wrap_new_coroutine(value)
                 return value
 
+        def _refresh(*args, **kwargs):
+            """Reloads an entry in the background, serving the old value until it is done."""
+            if not is_coroutine_function:
+                raise TypeError('refresh is only supported for coroutine functions')
+            key = _make_key(args, kwargs)
+            # a load that started before the change could still return old data
+            _inflight.pop(key, None)
+            return _load(key, func(*args, **kwargs), background=True)
+
         def _invalidate(*args, **kwargs):
+            key = _make_key(args, kwargs)
+            _inflight.pop(key, None)
             try:
-                del _internal_cache[_make_key(args, kwargs)]
+                del _internal_cache[key]
             except KeyError:
                 return False
             else:
+                _unindex(key)
                 return True
 
-        def _invalidate_containing(key):
-            to_remove = []
-            for k in _internal_cache.keys():
-                if key in k:
-                    to_remove.append(k)
-            for k in to_remove:
+        def _invalidate_containing(value):
+            """Invalidates every entry that was called with ``value`` as an argument."""
+            for k in [k for k in _inflight if value in k]:
+                del _inflight[k]
+            for k in list(_index.get(value, ())):
                 try:
                     del _internal_cache[k]
                 except KeyError:
-                    continue
+                    pass
+                _unindex(k)
+
+        def _invalidate_all():
+            _inflight.clear()
+            _internal_cache.clear()
+            _index.clear()
+
+        def _get_stats():
+            _stats.size = len(_internal_cache)
+            _stats.in_flight = len(_inflight)
+            return _stats
 
         wrapper.cache = _internal_cache
         wrapper.get_key = lambda *args, **kwargs: _make_key(args, kwargs)
         wrapper.invalidate = _invalidate
-        wrapper.get_stats = _stats
         wrapper.invalidate_containing = _invalidate_containing
+        wrapper.invalidate_all = _invalidate_all
+        wrapper.refresh = _refresh
+        wrapper.get_stats = _get_stats
+        cached_functions[_stats.name] = wrapper
         return wrapper
     return decorator
@@ -0,0 +1,61 @@
+from collections import defaultdict
+
+from loguru import logger
+
+
+class ClaimIndex:
+    """Both directions of the ``claims`` table, clan tag to guild ids and back.
+
+    The whole table is loaded once at startup. After that a clan's claims are
+    reloaded whenever the ``claims`` trigger (or a command) invalidates it on
+    the :class:`~cogs.utils.invalidation.InvalidationBus`, so lookups never
+    touch the database.
+    """
+
+    def __init__(self):
+        self._guilds = defaultdict(set)
+        self._clans = defaultdict(set)
+        self.loaded = False
+
+    def __len__(self):
+        return sum(len(n) for n in self._guilds.values())
+
+    def guilds_for(self, clan_tag):
+        """The ids of the guilds claiming ``clan_tag``."""
+        return frozenset(self._guilds.get(clan_tag, ()))
+
+    def clans_for(self, guild_id):
+        """The tags of the clans claimed by ``guild_id``."""
+        return frozenset(self._clans.get(guild_id, ()))
+
+    def add(self, guild_id, clan_tag):
+        self._guilds[clan_tag].add(guild_id)
+        self._clans[guild_id].add(clan_tag)
+
+    def remove(self, guild_id, clan_tag):
+        for index, key, value in ((self._guilds, clan_tag, guild_id), (self._clans, guild_id, clan_tag)):
+            values = index.get(key)
+            if values is None:
+                continue
+            values.discard(value)
+            if not values:
+                del index[key]
+
+    def clear(self):
+        self._guilds.clear()
+        self._clans.clear()
+
+    async def load(self, db):
+        fetch = await db.fetch("all_claims", fresh=True)
+        self.clear()
+        for guild_id, clan_tag in fetch:
+            self.add(guild_id, clan_tag)
+        self.loaded = True
+        logger.info(f"Loaded {len(fetch)} claims")
+
+    async def reload_clan(self, db, clan_tag):
+        fetch = await db.fetch("claims_for_clan", clan_tag, fresh=True)
+        for guild_id in self.guilds_for(clan_tag):
+            self.remove(guild_id, clan_tag)
+        for (guild_id,) in fetch:
+            self.add(guild_id, clan_tag)
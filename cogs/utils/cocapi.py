@@ -0,0 +1,264 @@
+import aiohttp
+import asyncio
+import contextlib
+import contextvars
+import re
+import time
+
+from collections import OrderedDict
+
+from loguru import logger
+
+from cogs.utils import cache
+from cogs.utils.metrics import registry
+
+REQUEST_LATENCY = registry.histogram('pushbot_coc_request_seconds',
+                                     'Clash of Clans API request latency per endpoint',
+                                     ('endpoint',))
+THROTTLE_WAIT = registry.histogram('pushbot_coc_throttle_wait_seconds',
+                                   'Time spent waiting on the coc.py request throttler')
+THROTTLED = registry.counter('pushbot_coc_throttled_total',
+                             'Responses the API answered with 429, retries included, per endpoint', ('endpoint',))
+REQUEST_ERRORS = registry.counter('pushbot_coc_request_errors_total',
+                                  'Clash of Clans API requests that raised, per endpoint and exception',
+                                  ('endpoint', 'error'))
+
+_tag = re.compile(r'(%23|#)[0-9A-Z]+', re.IGNORECASE)
+_max_age = re.compile(r'max-age=(\d+)')
+
+# the Cache-Control headers of the request being made in this task
+_cache_control = contextvars.ContextVar('cache_control', default=None)
+# set while this task's requests must skip the ResponseCache
+_uncached = contextvars.ContextVar('uncached', default=False)
+
+
+def endpoint(route):
+    """Turns a coc.py route into a low-cardinality label, e.g. ``GET /players/{tag}``."""
+    path = getattr(route, 'path', None) or str(getattr(route, 'url', route))
+    return f"{getattr(route, 'method', 'GET')} {_tag.sub('{tag}', path.split('?')[0])}"
+
+
+@contextlib.contextmanager
+def uncached():
+    """Sends the requests made inside the block to the API, never to a :class:`ResponseCache`."""
+    token = _uncached.set(True)
+    try:
+        yield
+    finally:
+        _uncached.reset(token)
+
+
+class _TimedThrottle:
+    """Wraps the coc.py throttler so waiting for a slot is measured."""
+
+    def __init__(self, throttle):
+        self.throttle = throttle
+
+    def __getattr__(self, item):
+        return getattr(self.throttle, item)
+
+    async def __aenter__(self):
+        start = time.perf_counter()
+        try:
+            return await self.throttle.__aenter__()
+        finally:
+            THROTTLE_WAIT.observe(time.perf_counter() - start)
+
+    async def __aexit__(self, *args):
+        return await self.throttle.__aexit__(*args)
+
+
+class _EndpointStats:
+    """Puts one endpoint of a :class:`ResponseCache` in :data:`cache.cached_functions`."""
+
+    def __init__(self, name):
+        self.stats = cache.CacheStats(name, 'http')
+        cache.cached_functions[name] = self
+
+    def get_stats(self):
+        return self.stats
+
+
+class ResponseCache:
+    """Clan and player responses kept for as long as the API's ``Cache-Control: max-age`` allows.
+
+    The API serves the same body until ``max-age`` runs out anyway, so a hit
+    never hides newer data; it just leaves the request (and its throttle
+    slot) to someone else. Responses without the header are kept for
+    ``default_ttl`` seconds. Concurrent requests for the same URL share one
+    load, and every endpoint shows up in ``cache_stats`` and the cache
+    metrics.
+
+    Player polls from :class:`~cogs.utils.polling.PollScheduler` skip the
+    cache (see :func:`uncached`). They are paced by their own budget, and a
+    hit would only make a change show up later.
+
+    How stale a clan may be is decided by ``PushBot.get_cached_clan`` and
+    its soft TTL, which sit above this cache. This layer only collapses
+    requests made within ``max-age`` of each other.
+
+    Responses are handed out as is, so callers must not mutate them.
+    """
+
+    def __init__(self, maxsize=20000, default_ttl=30.0):
+        self.maxsize = maxsize
+        self.default_ttl = default_ttl
+        self._data = OrderedDict()
+        self._loading = {}
+        self._endpoints = {}
+
+    def __len__(self):
+        return len(self._data)
+
+    def cacheable(self, route, label):
+        return getattr(route, 'method', 'GET') == 'GET' and label.startswith(('GET /clans/', 'GET /players/'))
+
+    def ttl(self, headers):
+        if not headers:
+            return self.default_ttl
+        if 'no-store' in headers or 'no-cache' in headers:
+            return 0.0
+        match = _max_age.search(headers)
+        return float(match.group(1)) if match else self.default_ttl
+
+    def _stats(self, label):
+        try:
+            return self._endpoints[label].stats
+        except KeyError:
+            endpoint = self._endpoints[label] = _EndpointStats(f'cocapi.{label}')
+            return endpoint.stats
+
+    def _store(self, url, label, data, ttl):
+        if ttl <= 0:
+            return
+        if url in self._data:
+            self._stats(self._data.pop(url)[2]).size -= 1
+        self._data[url] = (data, time.monotonic() + ttl, label)
+        self._stats(label).size += 1
+        while len(self._data) > self.maxsize:
+            _, (_, _, old_label) = self._data.popitem(last=False)
+            stats = self._stats(old_label)
+            stats.size -= 1
+            stats.evictions += 1
+
+    async def get(self, url, label, load):
+        stats = self._stats(label)
+        entry = self._data.get(url)
+        if entry is not None:
+            if entry[1] > time.monotonic():
+                stats.hits += 1
+                return entry[0]
+            del self._data[url]
+            stats.size -= 1
+            stats.evictions += 1
+        stats.misses += 1
+
+        future = self._loading.get(url)
+        if future is not None:
+            stats.coalesced += 1
+            return await asyncio.shield(future)
+
+        future = self._loading[url] = asyncio.get_event_loop().create_future()
+        stats.in_flight += 1
+        started = time.perf_counter()
+        headers = []
+        token = _cache_control.set(headers)
+        try:
+            data = await load()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # nobody else may be waiting, so don't let it go unretrieved
+            future.exception()
+            raise
+        else:
+            self._store(url, label, data, self.ttl(headers[-1] if headers else None))
+            future.set_result(data)
+            return data
+        finally:
+            _cache_control.reset(token)
+            stats.in_flight -= 1
+            stats.record_load(time.perf_counter() - started)
+            del self._loading[url]
+
+
+async def _on_request_end(session, context, params):
+    if params.response.status == 429:
+        THROTTLED.inc(endpoint=f"{params.method} {_tag.sub('{tag}', params.url.path)}")
+    headers = _cache_control.get()
+    if headers is not None:
+        headers.append(params.response.headers.get('Cache-Control'))
+
+
+def _trace(session):
+    """Adds the 429 and ``Cache-Control`` hook to an already created aiohttp session."""
+    config = aiohttp.TraceConfig()
+    config.on_request_end.append(_on_request_end)
+    config.freeze()
+    configs = getattr(session, '_trace_configs', None)
+    if configs is None:
+        return False
+    configs.append(config)
+    return True
+
+
+def use_api(url):
+    """Points coc.py at another API, such as ``benchmarks.cocserver``, for clients logged in afterwards."""
+    from coc.http import Route
+
+    Route.BASE = f'{url.rstrip("/")}/v1'
+    Route.API_PAGE_BASE = f'{url.rstrip("/")}/api'
+    logger.warning(f"Using the Clash of Clans API at {url}")
+
+
+def instrument(client, *, response_cache=None):
+    """Hooks request latency and throttle waits on a logged in coc.py client.
+
+    429 responses are counted with an aiohttp trace hook on coc.py's
+    session, which sees the requests coc.py retries by itself too.
+
+    With ``response_cache`` clan and player lookups are answered from a
+    :class:`ResponseCache` as well. The same hook reads ``Cache-Control``;
+    if there's no session to hook every response gets the cache's
+    ``default_ttl``.
+
+    This leans on coc.py's ``HTTPClient`` internals, so anything that can't
+    be found is simply left unmeasured.
+    """
+    http = getattr(client, 'http', None)
+    if http is None or getattr(http, '_pushbot_instrumented', False):
+        return
+
+    original = http.request
+
+    session = getattr(http, '_HTTPClient__session', None)
+    if session is None or not _trace(session):
+        logger.warning("Could not hook the coc session, 429s go uncounted and cached responses "
+                       "use the default TTL")
+
+    async def request(route, **kwargs):
+        label = endpoint(route)
+        if response_cache is not None and not _uncached.get() and response_cache.cacheable(route, label):
+            url = getattr(route, 'url', None) or str(route)
+            return await response_cache.get(url, label, lambda: timed(route, label, kwargs))
+        return await timed(route, label, kwargs)
+
+    async def timed(route, label, kwargs):
+        start = time.perf_counter()
+        try:
+            return await original(route, **kwargs)
+        except Exception as e:
+            REQUEST_ERRORS.inc(endpoint=label, error=e.__class__.__name__)
+            raise
+        finally:
+            REQUEST_LATENCY.observe(time.perf_counter() - start, endpoint=label)
+
+    http.request = request
+
+    throttle = getattr(http, '_HTTPClient__throttle', None)
+    if throttle is not None:
+        http._HTTPClient__throttle = _TimedThrottle(throttle)
+
+    http._pushbot_instrumented = True
@@ -1,6 +1,9 @@
 from discord.ext import commands
+from . import db
+from .outbound import Priority
 import asyncio
 import discord
+import functools
 import io
 
 
@@ -53,6 +56,18 @@ class Context(commands.Context):
     def session(self):
         return self.bot.session
 
+    async def get_clans(self):
+        """The clans claimed by this guild, through the shared clan cache."""
+        if self.guild is None:
+            return []
+        return await self.bot.get_clans(self.bot.claims.clans_for(self.guild.id))
+
+    async def send(self, content=None, **kwargs):
+        """Same as send except it goes through the bot's outbound queue
+        ahead of any logging traffic."""
+        factory = functools.partial(super().send, content, **kwargs)
+        return await self.bot.outbound.submit(self.channel.id, factory, priority=Priority.interactive)
+
     async def disambiguate(self, matches, entry):
         if len(matches) == 0:
             raise ValueError('No results found.')
@@ -66,7 +81,7 @@ class Context(commands.Context):
         def check(m):
             return m.content.isdigit() and m.author.id == self.author.id and m.channel.id == self.channel.id
 
-        await self.release()
+        held = await self.release_for_input()
 
         # only give them 3 tries.
         try:
@@ -84,7 +99,8 @@ class Context(commands.Context):
 
             raise ValueError('Too many tries. Goodbye.')
         finally:
-            await self.acquire()
+            if held:
+                await self.acquire()
 
     async def prompt(self, message, *, timeout=60.0, delete_after=True, reacquire=True, author_id=None):
         """An interactive reaction confirmation dialog.
@@ -98,8 +114,8 @@ class Context(commands.Context):
         delete_after: bool
             Whether to delete the confirmation message after we're done.
         reacquire: bool
-            Whether to release the database connection and then acquire it
-            again when we're done.
+            Whether to acquire the database connection again when we're done,
+            if one was held. It is always released while waiting.
         author_id: Optional[int]
             The member who should respond to the prompt. Defaults to the author of the
             Context's message.
@@ -142,8 +158,7 @@ class Context(commands.Context):
         for emoji in ('\N{WHITE HEAVY CHECK MARK}', '\N{CROSS MARK}'):
             await msg.add_reaction(emoji)
 
-        if reacquire:
-            await self.release()
+        held = await self.release_for_input()
 
         try:
             await self.bot.wait_for('raw_reaction_add', check=check, timeout=timeout)
@@ -151,7 +166,7 @@ class Context(commands.Context):
             confirm = None
 
         try:
-            if reacquire:
+            if reacquire and held:
                 await self.acquire()
 
             if delete_after:
@@ -172,13 +187,30 @@ class Context(commands.Context):
 
     @property
     def db(self):
+        """The connection held by :meth:`acquire`, otherwise the pool.
+
+        Statements run on the pool lease a connection only for as long as
+        they take, so commands should only hold one for a transaction.
+        """
         return self._db if self._db else self.pool
 
     async def _acquire(self, timeout):
         if self._db is None:
-            self._db = await self.pool.acquire(timeout=timeout)
+            self._db = await db.acquire(self.pool, timeout=timeout)
         return self._db
 
+    async def release_for_input(self):
+        """Releases the held connection before waiting on the user.
+
+        Returns whether one was held.
+        """
+        if self._db is None:
+            return False
+        if self._db.is_in_transaction():
+            raise RuntimeError('Cannot wait for user input inside a database transaction.')
+        await self.release()
+        return True
+
     def acquire(self, *, timeout=None):
         """Acquires a database connection from the pool. e.g. ::
 
@@ -1,12 +1,493 @@
+import asyncio
 import asyncpg
-from config import settings
+import contextvars
+import json
+import os
+import re
+import sys
+import time
+
+from loguru import logger
+
+from cogs.utils.metrics import registry
+
+QUERY_LATENCY = registry.histogram('pushbot_db_query_seconds',
+                                   'Postgres query latency per statement',
+                                   ('statement',))
+SLOW_QUERIES = registry.counter('pushbot_db_slow_queries_total',
+                               'Statements slower than the slow query threshold, per cog',
+                               ('cog',))
+ACQUIRE_SECONDS = registry.histogram('pushbot_db_acquire_seconds', 'Time spent waiting for a pooled connection')
+LEASE_SECONDS = registry.histogram('pushbot_db_lease_seconds', 'How long a pooled connection was held')
+LEASES = registry.gauge('pushbot_db_leases', 'Pooled connections currently held')
+LONG_LEASES = registry.counter('pushbot_db_long_leases_total',
+                               'Connections held longer than the lease warning threshold, per cog',
+                               ('cog',))
+POOL_MAX_SIZE = registry.gauge('pushbot_db_pool_max_size', 'Maximum size of each connection pool', ('pool',))
+ROUTED = registry.counter('pushbot_db_routed_total',
+                          'Catalog statements run on the primary or a read replica',
+                          ('pool',))
+
+_whitespace = re.compile(r'\s+')
+_literals = re.compile(r"'(?:[^']|'')*'|(?<![$\w])\d+\b")
+
+# (cog, command) of the command being invoked, set by PushBot.process_commands
+current_command = contextvars.ContextVar('current_command', default=None)
+
+# PushDB replaces these with pg.slow_query_ms and pg.lease_warning_ms from the config
+slow_query_seconds = 0.5
+lease_warning_seconds = 5.0
+
+_cogs_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_utils_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def normalize(query):
+    """Collapses whitespace and literals so the same statement always gets the same label."""
+    return _literals.sub('?', _whitespace.sub(' ', query)).strip()[:200]
+
+
+class StatementStats:
+    __slots__ = ('statement', 'calls', 'total_time', 'max_time', 'slow')
+
+    def __init__(self, statement):
+        self.statement = statement
+        self.calls = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.slow = 0
+
+    @property
+    def average_time(self):
+        return self.total_time / self.calls if self.calls else 0.0
+
+
+# normalized statement or catalog name -> StatementStats
+statement_stats = {}
+# ad hoc statements from Admin.sql shouldn't grow this forever
+MAX_STATEMENTS = 1000
+
+
+def _caller_cog():
+    """Names the cog module a query came from by walking up the stack.
+
+    Only called for slow queries, so the cost doesn't matter.
+    """
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if filename.startswith(_cogs_dir) and not filename.startswith(_utils_dir):
+            return os.path.splitext(os.path.basename(filename))[0]
+        frame = frame.f_back
+    return None
+
+
+def record(statement, elapsed):
+    """Records one run of ``statement`` and logs it if it was slow."""
+    # only catalog names become labels, anything ad hoc would grow the metric without bound
+    QUERY_LATENCY.observe(elapsed, statement=statement if statement in catalog else 'other')
+    stats = statement_stats.get(statement)
+    if stats is None:
+        key = statement if len(statement_stats) < MAX_STATEMENTS else '<other>'
+        stats = statement_stats.get(key)
+        if stats is None:
+            stats = statement_stats[key] = StatementStats(key)
+    stats.calls += 1
+    stats.total_time += elapsed
+    if elapsed > stats.max_time:
+        stats.max_time = elapsed
+    if elapsed < slow_query_seconds:
+        return
+
+    stats.slow += 1
+    cog, command = current_command.get() or (_caller_cog(), None)
+    SLOW_QUERIES.inc(cog=cog or 'unknown')
+    source = f"{cog or 'unknown'} ({command})" if command else (cog or 'unknown')
+    logger.warning(f"Slow query from {source} took {elapsed * 1000:.0f} ms: {statement}")
+
+
+class CatalogError(Exception):
+    """Raised when statements in the query catalog fail to prepare."""
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__('\n'.join(errors))
+
+
+class Query:
+    """A statement declared once in :data:`catalog`.
+
+    ``kind`` is ``'read'`` or ``'write'``.
+    """
+    __slots__ = ('name', 'sql', 'kind')
+
+    def __init__(self, name, sql, kind):
+        self.name = name
+        self.sql = sql
+        self.kind = kind
+
+    def __repr__(self):
+        return f'<Query name={self.name!r} kind={self.kind!r}>'
+
+
+catalog = {}
+
+
+def query(name, sql, kind='read'):
+    if name in catalog:
+        raise ValueError(f'{name} is already in the query catalog')
+    if kind not in ('read', 'write'):
+        raise ValueError(f'unknown query kind {kind!r}')
+    catalog[name] = q = Query(name, sql, kind)
+    return q
+
+
+# -- guilds and claims
+
+query('guild_config', "SELECT * FROM guilds WHERE guild_id = $1")
+query('guild_clan_tags', "SELECT DISTINCT clan_tag FROM clans WHERE guild_id = $1")
+query('guilds_for_clans', "SELECT DISTINCT guild_id FROM events e "
+                          "INNER JOIN clans c ON e.event_id = c.event_id "
+                          "WHERE clan_tag = ANY($1::TEXT[])")
+query('claims_for_clan', "SELECT guild_id FROM claims WHERE clan_tag = $1")
+query('all_claims', "SELECT guild_id, clan_tag FROM claims")
+
+# -- players and the pushboard
+
+query('all_players', "SELECT player_tag, clan_tag FROM players")
+query('clan_players', "SELECT player_tag FROM players WHERE clan_tag = $1")
+query('insert_players', "INSERT INTO players (player_tag, player_name, clan_tag, starting_trophies, current_trophies) "
+                        "SELECT json.player_tag, json.player_name, json.clan_tag, json.trophies, json.trophies "
+                        "FROM jsonb_to_recordset($1::jsonb) "
+                        "AS json(player_tag TEXT, player_name TEXT, clan_tag TEXT, trophies INTEGER) "
+                        "ON CONFLICT (player_tag) DO NOTHING "
+                        "RETURNING player_tag, clan_tag", 'write')
+query('running_clans', "SELECT DISTINCT c.clan_tag FROM clans c "
+                       "INNER JOIN events e ON e.event_id = c.event_id "
+                       "WHERE e.event_start_time <= CURRENT_TIMESTAMP AND e.event_end_time > CURRENT_TIMESTAMP")
+query('delete_clan_players', "DELETE FROM players WHERE clan_tag = $1 RETURNING player_tag", 'write')
+query('leaderboard_players', "SELECT player_tag, current_trophies, "
+                             "current_attack_wins - starting_attack_wins AS attacks "
+                             "FROM players "
+                             "WHERE player_tag = ANY($1::TEXT[]) "
+                             "ORDER BY current_trophies "
+                             "LIMIT 100")
+query('apply_trophy_changes', "UPDATE players p "
+                              "SET current_trophies = json.trophies, trophies_at = json.time_stamp "
+                              "FROM (SELECT DISTINCT ON (json.player_tag) json.player_tag, json.trophies, "
+                              "json.time_stamp "
+                              "FROM jsonb_to_recordset($1::jsonb) "
+                              "AS json(player_tag TEXT, trophies INTEGER, time_stamp TIMESTAMP) "
+                              "ORDER BY json.player_tag, json.time_stamp DESC) "
+                              "AS json "
+                              "WHERE p.player_tag = json.player_tag "
+                              "AND (p.trophies_at IS NULL OR p.trophies_at <= json.time_stamp)", 'write')
+query('enqueue_poll_events', "INSERT INTO poll_events (player_tag, player_name, clan_tag, clan_name, "
+                             "old_trophies, new_trophies, polled_at) "
+                             "SELECT json.player_tag, json.player_name, json.clan_tag, json.clan_name, "
+                             "json.old_trophies, json.new_trophies, json.polled_at "
+                             "FROM jsonb_to_recordset($1::jsonb) "
+                             "AS json(player_tag TEXT, player_name TEXT, clan_tag TEXT, clan_name TEXT, "
+                             "old_trophies INTEGER, new_trophies INTEGER, polled_at TIMESTAMP)", 'write')
+query('claim_poll_events', "UPDATE poll_events SET claimed_at = CURRENT_TIMESTAMP WHERE id IN "
+                           "(SELECT id FROM poll_events "
+                           "WHERE claimed_at IS NULL OR claimed_at < CURRENT_TIMESTAMP - make_interval(secs => $2) "
+                           "ORDER BY id LIMIT $1 FOR UPDATE SKIP LOCKED) "
+                           "RETURNING id, player_tag, player_name, clan_tag, clan_name, "
+                           "old_trophies, new_trophies, polled_at", 'write')
+query('ack_poll_events', "DELETE FROM poll_events WHERE id = any($1::BIGINT[])", 'write')
+query('guild_messages', "SELECT * FROM messages WHERE guild_id = $1")
+query('message', "SELECT id, guild_id, message_id, channel_id FROM messages WHERE message_id = $1")
+query('insert_message', "INSERT INTO messages (guild_id, message_id, channel_id) VALUES ($1, $2, $3)", 'write')
+query('delete_message', "DELETE FROM messages WHERE message_id = $1 "
+                        "RETURNING id, guild_id, message_id, channel_id", 'write')
+
+# -- events and logs
+
+query('insert_coc_events', "INSERT INTO coc_events (player_tag, player_name, clan_tag, clan_name, "
+                           "trophy_change, time_stamp, poll_event_id) "
+                           "SELECT json.player_tag, json.player_name, json.clan_tag, json.clan_name, "
+                           "json.trophy_change, json.time_stamp, json.poll_event_id "
+                           "FROM jsonb_to_recordset($1::jsonb) "
+                           "AS json(player_tag TEXT, player_name TEXT, clan_tag TEXT, clan_name TEXT, "
+                           "trophy_change INTEGER, time_stamp TIMESTAMP, poll_event_id BIGINT) "
+                           "ON CONFLICT (poll_event_id) WHERE poll_event_id IS NOT NULL DO NOTHING", 'write')
+query('unreported_channels', "SELECT DISTINCT channel_id FROM events e "
+                             "INNER JOIN clans c ON e.event_id = c.event_id "
+                             "INNER JOIN coc_events ce ON c.clan_tag = ce.clan_tag AND NOT ce.reported")
+query('unreported_events', "SELECT * FROM coc_events ce "
+                           "INNER JOIN clans c ON ce.clan_tag = c.clan_tag "
+                           "INNER JOIN events e ON c.event_id = e.event_id "
+                           "WHERE e.channel_id = $1 "
+                           "AND NOT ce.reported "
+                           "ORDER BY e.event_id, ce.time_stamp DESC")
+query('mark_reported', "UPDATE coc_events SET reported = True WHERE NOT reported", 'write')
+query('channel_config', "SELECT event_id, guild_id, event_name, channel_id, log_interval, log_toggle "
+                        "FROM events WHERE channel_id = $1")
+query('channel_configs', "SELECT event_id, guild_id, event_name, channel_id, log_interval, log_toggle "
+                         "FROM events WHERE channel_id = ANY($1::BIGINT[])")
+query('all_channel_configs', "SELECT event_id, guild_id, event_name, channel_id, log_interval, log_toggle "
+                             "FROM events WHERE channel_id IS NOT NULL")
+query('next_log_timer', "SELECT * FROM log_timers ORDER BY expires LIMIT 1")
+query('insert_log_timer', "INSERT INTO log_timers (channel_id, fmt, expires) VALUES ($1, $2, $3)", 'write')
+query('delete_log_timer', "DELETE FROM log_timers WHERE id = $1", 'write')
+
+# -- recent
+
+query('recent_guild', "SELECT player_name, clan_name, trophy_change, time_stamp "
+                      "FROM coc_events "
+                      "WHERE clan_tag IN "
+                      "(SELECT clan_tag FROM clans WHERE event_id IN "
+                      "(SELECT event_id FROM events WHERE guild_id = $1)) "
+                      "ORDER BY time_stamp DESC "
+                      "LIMIT $2")
+query('recent_player', "SELECT player_name, clan_name, trophy_change, time_stamp "
+                       "FROM coc_events "
+                       "WHERE player_tag = $1 "
+                       "ORDER BY time_stamp DESC "
+                       "LIMIT $2")
+query('recent_clans', "SELECT player_name, clan_name, trophy_change, time_stamp "
+                      "FROM coc_events "
+                      "WHERE clan_tag = ANY($1::TEXT[]) "
+                      "ORDER BY time_stamp DESC "
+                      "LIMIT $2")
+
+
+class TimedConnection(asyncpg.Connection):
+    """An asyncpg connection recording the latency of every statement it runs.
+
+    The pool's own ``fetch``/``execute`` helpers acquire one of these and call
+    straight into it, so both ``bot.pool`` and ``ctx.db`` are covered.
+
+    Catalog statements are prepared once by :meth:`prepare_catalog` when the
+    pool opens the connection and run by name with :meth:`run`.
+    """
+
+    async def _timed(self, method, query, args, kwargs):
+        start = time.perf_counter()
+        try:
+            return await method(query, *args, **kwargs)
+        finally:
+            record(normalize(query), time.perf_counter() - start)
+
+    async def execute(self, query, *args, **kwargs):
+        return await self._timed(super().execute, query, args, kwargs)
+
+    async def fetch(self, query, *args, **kwargs):
+        return await self._timed(super().fetch, query, args, kwargs)
+
+    async def fetchrow(self, query, *args, **kwargs):
+        return await self._timed(super().fetchrow, query, args, kwargs)
+
+    async def fetchval(self, query, *args, **kwargs):
+        return await self._timed(super().fetchval, query, args, kwargs)
+
+    def lease_started(self):
+        """Called by the pool's setup hook each time the connection is acquired."""
+        self._leased_at = time.monotonic()
+        self._lease_command = current_command.get()
+        LEASES.inc()
+
+    async def reset(self, *, timeout=None):
+        # the pool resets a connection when it is released
+        leased_at = self.__dict__.pop('_leased_at', None)
+        if leased_at is not None:
+            LEASES.dec()
+            held = time.monotonic() - leased_at
+            LEASE_SECONDS.observe(held)
+            if held >= lease_warning_seconds:
+                cog, command = self._lease_command or (_caller_cog(), None)
+                LONG_LEASES.inc(cog=cog or 'unknown')
+                source = f"{cog or 'unknown'} ({command})" if command else (cog or 'unknown')
+                logger.warning(f"{source} held a database connection for {held:.1f} s")
+        await super().reset(timeout=timeout)
+
+    async def prepare_catalog(self, kinds=('read', 'write')):
+        """Prepares every catalog statement of the given kinds, raising
+        :exc:`CatalogError` listing all that fail."""
+        await self.set_type_codec('jsonb', encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
+        self._prepared = {}
+        errors = []
+        for q in catalog.values():
+            if q.kind not in kinds:
+                continue
+            try:
+                self._prepared[q.name] = await self.prepare(q.sql)
+            except asyncpg.PostgresError as e:
+                errors.append(f'{q.name}: {e.__class__.__name__}: {e}')
+        if errors:
+            raise CatalogError(errors)
+
+    async def run(self, method, name, *args):
+        """Runs the catalog statement ``name``.
+
+        ``method`` is one of ``execute``, ``fetch``, ``fetchrow`` or ``fetchval``.
+        Prepared statements have no ``execute``, so that goes through the
+        connection's own statement cache, which still reuses the plan.
+        """
+        q = catalog[name]
+        start = time.perf_counter()
+        try:
+            if method == 'execute':
+                return await super().execute(q.sql, *args)
+            prepared = self.__dict__.setdefault('_prepared', {})
+            for attempt in range(2):
+                statement = prepared.get(name)
+                if statement is None:
+                    statement = prepared[name] = await self.prepare(q.sql)
+                try:
+                    return await getattr(statement, method)(*args)
+                except asyncpg.InvalidCachedStatementError:
+                    # the table changed under the plan, prepare it again
+                    del prepared[name]
+                    if attempt:
+                        raise
+        finally:
+            record(name, time.perf_counter() - start)
+
+
+async def _init_connection(connection):
+    await connection.prepare_catalog()
+
+
+async def _init_reader(connection):
+    await connection.prepare_catalog(kinds=('read',))
+
+
+async def _setup_connection(proxy):
+    proxy.lease_started()
+
+
+async def acquire(pool, *, timeout=None):
+    """Acquires a connection from ``pool``, recording how long that took."""
+    start = time.perf_counter()
+    connection = await pool.acquire(timeout=timeout)
+    ACQUIRE_SECONDS.observe(time.perf_counter() - start)
+    return connection
 
 
 class PushDB:
+    """The primary pool plus any read replicas listed under ``pg.replicas`` in the config.
+
+    Catalog statements are routed by their kind. Writes always go to the
+    primary. Reads go to a replica, round robin, and fall back to the primary
+    if there is none or it can't be reached. A replica that fails is skipped
+    for :attr:`retry_after` seconds.
+
+    Replicas lag behind the primary, so a call site that must see a write it
+    (or another process) just made passes ``fresh=True`` to read from the
+    primary.
+    """
+    retry_after = 30.0
+
     def __init__(self, bot):
+        from config import settings
+
+        global slow_query_seconds, lease_warning_seconds
+        slow_query_seconds = settings['pg'].get('slow_query_ms', 500) / 1000
+        lease_warning_seconds = settings['pg'].get('lease_warning_ms', 5000) / 1000
+
         self.bot = bot
+        self.dsn = f"{settings['pg']['uri']}/pushbot"
+        self.replica_dsns = [f"{uri}/pushbot" for uri in settings['pg'].get('replicas', ())]
+        self.reader_max_size = settings['pg'].get('replica_max_size', 40)
+        self.pool = None
+        self.readers = []
+        self._down_until = {}
+        self._next_reader = 0
+
+    async def create_pool(self, *, max_size=85):
+        """Creates the pools. Fails with :exc:`CatalogError` if the catalog doesn't match the schema.
+
+        A replica that can't be reached at startup is left out with a warning.
+        """
+        self.pool = await asyncpg.create_pool(self.dsn, min_size=min(10, max_size), max_size=max_size,
+                                              connection_class=TimedConnection,
+                                              init=_init_connection, setup=_setup_connection)
+        POOL_MAX_SIZE.set(max_size, pool='primary')
+        for dsn in self.replica_dsns:
+            try:
+                reader = await asyncpg.create_pool(dsn, max_size=self.reader_max_size,
+                                                   connection_class=TimedConnection, init=_init_reader,
+                                                   setup=_setup_connection)
+            except (OSError, asyncpg.PostgresConnectionError) as e:
+                logger.warning(f"Read replica {dsn} is unavailable: {e}")
+                continue
+            self.readers.append(reader)
+        if self.readers:
+            POOL_MAX_SIZE.set(self.reader_max_size * len(self.readers), pool='replica')
+        return self.pool
+
+    async def close(self):
+        for reader in self.readers:
+            await reader.close()
+        self.readers.clear()
+        if self.pool is not None:
+            await self.pool.close()
+
+    def reader(self):
+        """Returns the next healthy replica pool, or the primary if there is none."""
+        now = time.monotonic()
+        for _ in range(len(self.readers)):
+            reader = self.readers[self._next_reader % len(self.readers)]
+            self._next_reader += 1
+            if self._down_until.get(reader, 0) <= now:
+                return reader
+        return self.pool
+
+    def pool_for(self, name, fresh=False):
+        if fresh or catalog[name].kind == 'write':
+            return self.pool
+        return self.reader()
+
+    async def _run(self, method, name, args, connection, fresh=False):
+        if connection is not None:
+            return await connection.run(method, name, *args)
+        pool = self.pool_for(name, fresh)
+        if pool is not self.pool:
+            try:
+                con = await acquire(pool)
+                try:
+                    ROUTED.inc(pool='replica')
+                    return await con.run(method, name, *args)
+                finally:
+                    await pool.release(con)
+            except (OSError, asyncpg.PostgresConnectionError) as e:
+                logger.warning(f"Read replica failed, retrying {name} on the primary: {e}")
+                self._down_until[pool] = time.monotonic() + self.retry_after
+        con = await acquire(self.pool)
+        try:
+            ROUTED.inc(pool='primary')
+            return await con.run(method, name, *args)
+        finally:
+            await self.pool.release(con)
+
+    async def execute(self, name, *args, connection=None):
+        return await self._run('execute', name, args, connection)
+
+    async def fetch(self, name, *args, connection=None, fresh=False):
+        return await self._run('fetch', name, args, connection, fresh)
+
+    async def fetchrow(self, name, *args, connection=None, fresh=False):
+        return await self._run('fetchrow', name, args, connection, fresh)
+
+    async def fetchval(self, name, *args, connection=None, fresh=False):
+        return await self._run('fetchval', name, args, connection, fresh)
+
+
+async def validate(dsn):
+    """Prepares the whole catalog against ``dsn``, e.g. a local copy of the schema."""
+    connection = await asyncpg.connect(dsn, connection_class=TimedConnection)
+    try:
+        await connection.prepare_catalog()
+    finally:
+        await connection.close()
+
 
-    @staticmethod
-    async def create_pool():
-        pool = await asyncpg.create_pool(f"{settings['pg']['uri']}/pushbot", max_size=85)
-        return pool
+if __name__ == '__main__':
+    # python -m cogs.utils.db postgres://localhost/pushbot
+    try:
+        asyncio.get_event_loop().run_until_complete(validate(sys.argv[1]))
+    except CatalogError as e:
+        print(e)
+        sys.exit(1)
+    print(f'{len(catalog)} statements prepared')
@@ -7,7 +7,7 @@ from cogs.utils.formatters import readable_time
 class DatabaseGuild:
     __slots__ = ('bot', 'guild_id', 'id', 'updates_channel_id', 'updates_header_id', 'updates_toggle',
                  'log_channel_id', 'log_toggle', 'ign', 'don', 'rec', 'tag', 'claimed_by', 'clan',
-                 'auto_claim', 'donationboard_title', 'icon_url', 'donationboard_render', 'log_interval')
+                 'auto_claim', 'pushboard_title', 'icon_url', 'pushboard_render', 'log_interval')
 
     def __init__(self, *, guild_id, bot, record=None):
         self.guild_id = guild_id
@@ -27,9 +27,9 @@ class DatabaseGuild:
             self.claimed_by = record['updates_claimed_by']
             self.clan = record['updates_clan']  # record['updates_clan']
             self.auto_claim = record['auto_claim']
-            self.donationboard_title = record['donationboard_title']
+            self.pushboard_title = record['pushboard_title']
             self.icon_url = record['icon_url']
-            self.donationboard_render = record['donationboard_render']
+            self.pushboard_render = record['pushboard_render']
             self.log_interval = record['log_interval']
         else:
             self.updates_channel_id = None
@@ -42,27 +42,79 @@ class DatabaseGuild:
     def pushboard(self):
         return self.bot.get_channel(self.updates_channel_id)
 
+    # the board formatters were written against these names
+    @property
+    def donationboard_title(self):
+        return self.pushboard_title
+
+    @property
+    def donationboard_render(self):
+        return self.pushboard_render
+
     @property
     def log_channel(self):
         guild = self.bot.get_guild(self.guild_id)
         return guild and guild.get_channel(self.log_channel_id)
 
     async def updates_messages(self):
-        query = "SELECT * FROM messages WHERE guild_id = $1"
-        fetch = await self.bot.pool.fetch(query, self.guild_id)
+        fetch = await self.bot.db.fetch("guild_messages", self.guild_id)
         return [DatabaseMessage(bot=self.bot, record=n) for n in fetch]
 
 
-class DatabaseClan:
-    def __init__(self, *, bot, clan_tag=None, record=None):
+class _Field:
+    """Reads a column from the wrapped record when the attribute is accessed.
+
+    Columns the query didn't select read as ``None``.
+    """
+    __slots__ = ('column',)
+
+    def __init__(self, column):
+        self.column = column
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return instance._record.get(self.column)
+
+    def __set__(self, instance, value):
+        record = instance._record
+        if not isinstance(record, dict):
+            # asyncpg records are read only, so copy on the first write
+            record = instance._record = dict(record.items())
+        record[self.column] = value
+
+
+class _RecordView:
+    """Base for thin wrappers over an asyncpg Record.
+
+    Without a record the fields live in a plain dict, filled in from
+    ``_defaults`` and the keyword arguments.
+    """
+    __slots__ = ('bot', '_record')
+    _defaults = {}
+
+    def __init__(self, *, bot, record=None, **fields):
         self.bot = bot
+        if not record:
+            record = {}
+            cls = type(self)
+            for name, value in {**self._defaults, **fields}.items():
+                record[getattr(cls, name).column] = value
+        self._record = record
+
+
+class DatabaseClan(_RecordView):
+    __slots__ = ()
 
+    id = _Field('clan_id')
+    clan_tag = _Field('clan_tag')
+    event_id = _Field('event_id')
+
+    def __init__(self, *, bot, clan_tag=None, record=None):
         if record:
-            self.id = record["clan_id"]
-            self.clan_tag = record["clan_tag"]
-            self.event_id = record["event_id"]
+            super().__init__(bot=bot, record=record)
         else:
-            self.clan_tag = coc.utils.correct_tag(clan_tag)
+            super().__init__(bot=bot, clan_tag=coc.utils.correct_tag(clan_tag))
 
     async def full_clan(self):
         clan = await self.bot.coc.get_clan(self.clan_tag)
@@ -70,20 +122,17 @@ class DatabaseClan:
         return clan
 
 
-class DatabasePlayer:
-    def __init__(self, *, bot, player_tag=None, record=None):
-        self.bot = bot
+class DatabasePlayer(_RecordView):
+    __slots__ = ()
 
-        if record:
-            self.id = record['player_id']
-            self.player_name = record['player_name']
-            self.player_tag = record['player_tag']
-            self.current_trophies = record['current_trophies']
-            self.attacks = record['attacks']
-            self.user_id = record['user_id']
-        else:
-            self.user_id = None
-            self.player_tag = player_tag
+    id = _Field('player_id')
+    player_name = _Field('player_name')
+    player_tag = _Field('player_tag')
+    current_trophies = _Field('current_trophies')
+    attacks = _Field('attacks')
+    user_id = _Field('user_id')
+
+    _defaults = {'user_id': None}
 
     @property
     def owner(self):
@@ -93,19 +142,17 @@ class DatabasePlayer:
         return await self.bot.coc.get_player(self.player_tag)
 
 
-class DatabasePushEvent:
-    def __init__(self, *, bot, record=None):
-        self.bot = bot
+class DatabasePushEvent(_RecordView):
+    __slots__ = ()
 
-        if record:
-            self.id = record['event_id']
-            self.guild_id = record['guild_id']
-            self.event_name = record['event_name']
-            self.channel_id = record['channel_id']
-            self.log_interval = record['log_interval']
-            self.log_toggle = record['log_toggle']
-        else:
-            self.guild_id = None
+    id = _Field('event_id')
+    guild_id = _Field('guild_id')
+    event_name = _Field('event_name')
+    channel_id = _Field('channel_id')
+    log_interval = _Field('log_interval')
+    log_toggle = _Field('log_toggle')
+
+    _defaults = {'guild_id': None}
 
     @property
     def guild(self):
@@ -120,20 +167,15 @@ class DatabasePushEvent:
         return self.log_interval.total_seconds()
 
 
-class DatabaseMessage:
-    def __init__(self, *, bot, record=None):
-        self.bot = bot
+class DatabaseMessage(_RecordView):
+    __slots__ = ()
 
-        if record:
-            self.id = record['id']
-            self.guild_id = record['guild_id']
-            self.message_id = record['message_id']
-            self.channel_id = record['channel_id']
+    id = _Field('id')
+    guild_id = _Field('guild_id')
+    message_id = _Field('message_id')
+    channel_id = _Field('channel_id')
 
-        else:
-            self.guild_id = None
-            self.channel_id = None
-            self.message_id = None
+    _defaults = {'guild_id': None, 'channel_id': None, 'message_id': None}
 
     @property
     def guild(self):
@@ -144,22 +186,37 @@ class DatabaseMessage:
         return self.bot.get_channel(self.channel_id)
 
     async def get_message(self):
-        return await self.bot.donationboard.get_message(self.channel, self.message_id)
+        return await self.bot.push_board.get_message(self.channel, self.message_id)
 
 
-class DatabaseEvent:
-    def __init__(self, *, bot, record=None):
-        self.bot = bot
+class MessageHandle:
+    """A compact stand-in for a pushboard ``discord.Message``.
 
-        if record:
-            self.id = record['coc_event_id']
-            self.player_tag = record['player_tag']
-            self.clan_tag = record['clan_tag']
-            self.trophy_change = record['trophy_change']
-            self.time = record['time_stamp']
+    ``render_hash`` is the hash of the embed last written to the message,
+    so unchanged boards are not edited again.
+    """
+    __slots__ = ('channel_id', 'message_id', 'render_hash')
 
-        else:
-            self.time = None
+    def __init__(self, channel_id, message_id, render_hash=None):
+        self.channel_id = channel_id
+        self.message_id = message_id
+        self.render_hash = render_hash
+
+    @property
+    def id(self):
+        return self.message_id
+
+
+class DatabaseEvent(_RecordView):
+    __slots__ = ()
+
+    id = _Field('coc_event_id')
+    player_tag = _Field('player_tag')
+    clan_tag = _Field('clan_tag')
+    trophy_change = _Field('trophy_change')
+    time = _Field('time_stamp')
+
+    _defaults = {'time': None}
 
     @property
     def readable_time(self):
@@ -0,0 +1,156 @@
+import asyncio
+import asyncpg
+import json
+import uuid
+
+from loguru import logger
+
+CHANNEL = 'pushbot_cache'
+
+# Keeps every process in sync with writes that don't go through a bot command,
+# e.g. Admin.sql or a psql session. Applied by migration 2 in cogs.utils.migrations.
+TRIGGER_SQL = """
+CREATE OR REPLACE FUNCTION pushbot_notify_invalidation() RETURNS trigger AS $$
+DECLARE
+    row RECORD;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        row := OLD;
+    ELSE
+        row := NEW;
+    END IF;
+    IF TG_TABLE_NAME = 'guilds' THEN
+        PERFORM pg_notify('pushbot_cache', json_build_object('cache', 'guild_config', 'key', row.guild_id)::text);
+    ELSIF TG_TABLE_NAME = 'events' THEN
+        PERFORM pg_notify('pushbot_cache', json_build_object('cache', 'channel_config', 'key', row.channel_id)::text);
+        IF TG_OP = 'UPDATE' AND OLD.channel_id IS DISTINCT FROM NEW.channel_id THEN
+            PERFORM pg_notify('pushbot_cache',
+                              json_build_object('cache', 'channel_config', 'key', OLD.channel_id)::text);
+        END IF;
+    ELSIF TG_TABLE_NAME = 'messages' THEN
+        PERFORM pg_notify('pushbot_cache', json_build_object('cache', 'message', 'key', row.message_id)::text);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS pushbot_invalidate ON guilds;
+CREATE TRIGGER pushbot_invalidate AFTER UPDATE OR DELETE ON guilds
+    FOR EACH ROW EXECUTE PROCEDURE pushbot_notify_invalidation();
+DROP TRIGGER IF EXISTS pushbot_invalidate ON events;
+CREATE TRIGGER pushbot_invalidate AFTER INSERT OR UPDATE OR DELETE ON events
+    FOR EACH ROW EXECUTE PROCEDURE pushbot_notify_invalidation();
+DROP TRIGGER IF EXISTS pushbot_invalidate ON messages;
+CREATE TRIGGER pushbot_invalidate AFTER DELETE ON messages
+    FOR EACH ROW EXECUTE PROCEDURE pushbot_notify_invalidation();
+"""
+
+# Keeps the claim index current. Both the old and the new clan are sent on an update.
+CLAIMS_TRIGGER_SQL = """
+CREATE OR REPLACE FUNCTION pushbot_notify_claims() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        PERFORM pg_notify('pushbot_cache', json_build_object('cache', 'claims', 'key', OLD.clan_tag)::text);
+    END IF;
+    IF TG_OP <> 'DELETE' THEN
+        PERFORM pg_notify('pushbot_cache', json_build_object('cache', 'claims', 'key', NEW.clan_tag)::text);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS pushbot_invalidate ON claims;
+CREATE TRIGGER pushbot_invalidate AFTER INSERT OR UPDATE OR DELETE ON claims
+    FOR EACH ROW EXECUTE PROCEDURE pushbot_notify_claims();
+"""
+
+
+class InvalidationBus:
+    """Evicts cache entries in every bot process when one of them changes the data behind them.
+
+    Caches register a handler under a name. :meth:`publish` runs the local
+    handler straight away and sends a ``NOTIFY`` on :data:`CHANNEL`, which
+    every other process receives on its own dedicated ``LISTEN`` connection.
+
+    A handler is called with the key that changed, or ``None`` if it should
+    drop everything. That happens after the listening connection was lost,
+    since notifications sent in the meantime are gone.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.origin = uuid.uuid4().hex
+        self.handlers = {}
+        self._connection = None
+        self._task = None
+
+    def register(self, name, handler):
+        self.handlers[name] = handler
+
+    def unregister(self, name):
+        self.handlers.pop(name, None)
+
+    def _dispatch(self, name, key):
+        handler = self.handlers.get(name)
+        if handler is None:
+            return
+        try:
+            handler(key)
+        except Exception:
+            logger.exception(f"Cache invalidation handler for {name} failed")
+
+    def _on_notification(self, connection, pid, channel, payload):
+        try:
+            data = json.loads(payload)
+        except ValueError:
+            return
+        if data.get('origin') == self.origin:
+            # published by us, so it has already been handled locally
+            return
+        self._dispatch(data.get('cache'), data.get('key'))
+
+    async def publish(self, name, key=None, *, connection=None, local=True):
+        """Invalidates ``key`` in the ``name`` cache here and in every other process.
+
+        Pass ``local=False`` when this process has already brought its own
+        cache up to date.
+        """
+        if local:
+            self._dispatch(name, key)
+        payload = json.dumps({'cache': name, 'key': key, 'origin': self.origin})
+        await (connection or self.bot.pool).execute("SELECT pg_notify($1, $2)", CHANNEL, payload)
+
+    def start(self, dsn):
+        if self._task is None:
+            self._task = self.bot.loop.create_task(self._listen(dsn))
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
+
+    async def _listen(self, dsn):
+        backoff = 1
+        connected_before = False
+        while True:
+            try:
+                self._connection = await asyncpg.connect(dsn)
+                await self._connection.add_listener(CHANNEL, self._on_notification)
+            except (OSError, asyncpg.PostgresError) as e:
+                logger.warning(f"Cache invalidation listener could not connect: {e}")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+                continue
+
+            backoff = 1
+            if connected_before:
+                for name in list(self.handlers):
+                    self._dispatch(name, None)
+            connected_before = True
+
+            while not self._connection.is_closed():
+                await asyncio.sleep(5)
+            logger.warning("Cache invalidation listener lost its connection, reconnecting")
@@ -0,0 +1,101 @@
+import asyncio
+import discord
+
+from collections import OrderedDict
+
+from .outbound import Priority, TokenBucket
+
+
+class DiscordLogSink:
+    """A loguru sink that batches records into code blocks for the log channel.
+
+    Records are buffered and flushed every ``interval`` seconds. Identical
+    messages within one batch are collapsed into a single line with a
+    repeat count, and the sink never sends more than ``per_minute``
+    messages a minute. Anything over that is counted and reported on the
+    next flush instead of being sent.
+
+    Usage: ::
+
+        sink = DiscordLogSink(bot)
+        logger.add(sink, level="INFO")
+        sink.start()
+    """
+
+    def __init__(self, bot, *, interval=5.0, per_minute=12, max_lines=500):
+        self.bot = bot
+        self.interval = interval
+        self.max_lines = max_lines
+        self.suppressed = 0
+        self._lines = OrderedDict()
+        self._bucket = TokenBucket(per_minute / 60, per_minute)
+        self._task = None
+
+    def __call__(self, message):
+        record = message.record
+        key = (record['level'].name, record['message'])
+        try:
+            self._lines[key][1] += 1
+        except KeyError:
+            if len(self._lines) >= self.max_lines:
+                _, (_, count) = self._lines.popitem(last=False)
+                self.suppressed += count
+            # a fence in the message would end the code block early, so break up every backtick run
+            body = record['message'].replace('`', '`\u200b')
+            text = f"{record['time']:%H:%M:%S} {record['level'].name:<7} {body}"
+            self._lines[key] = [text, 1]
+
+    def start(self):
+        if self._task is None:
+            self._task = self.bot.loop.create_task(self._flush_loop())
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def _chunks(self, lines):
+        """Splits ``(line, records)`` pairs into chunks that fit in one message."""
+        chunk = []
+        size = 0
+        for line, records in lines:
+            # leave room for the code block fences
+            line = line[:1900]
+            if size + len(line) + 1 > 1900:
+                yield chunk
+                chunk = []
+                size = 0
+            chunk.append((line, records))
+            size += len(line) + 1
+        if chunk:
+            yield chunk
+
+    async def flush(self):
+        channel = self.bot.log_channel
+        if channel is None or not self._lines:
+            return
+
+        # each line with the number of records it stands for
+        lines = [(text if count == 1 else f'{text} (x{count})', count) for text, count in self._lines.values()]
+        self._lines.clear()
+        if self.suppressed:
+            lines.append((f'... {self.suppressed} log line(s) suppressed', self.suppressed))
+            self.suppressed = 0
+
+        chunks = list(self._chunks(lines))
+        for index, chunk in enumerate(chunks):
+            if self._bucket.delay():
+                self.suppressed += sum(records for c in chunks[index:] for _, records in c)
+                return
+            self._bucket.consume()
+            content = '```\n{}\n```'.format('\n'.join(line for line, _ in chunk))
+            try:
+                await self.bot.outbound.send(channel, content=content, priority=Priority.background)
+            except (discord.HTTPException, asyncio.QueueFull):
+                # logging this would only feed it straight back into us
+                self.suppressed += sum(records for _, records in chunk)
@@ -0,0 +1,212 @@
+import bisect
+import time
+
+from aiohttp import web
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(pairs) + '}'
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(labels[n] for n in self.labelnames)
+
+    def clear(self):
+        self._values.clear()
+
+    def render(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} {self.type}'
+        for key, value in self._values.items():
+            yield f'{self.name}{_format_labels(self.labelnames, key)} {value}'
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def set_total(self, value, **labels):
+        """Copies in a running total kept elsewhere, e.g. by a collector callback."""
+        self._values[self._key(labels)] = value
+
+    def total(self):
+        """The count summed over every label combination."""
+        return sum(self._values.values())
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        try:
+            counts, total = self._values[key]
+        except KeyError:
+            counts = [0] * (len(self.buckets) + 1)
+            total = 0.0
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._values[key] = (counts, total + value)
+
+    def summary(self, **labels):
+        """Returns the number and the sum of the values observed with ``labels``."""
+        counts, total = self._values.get(self._key(labels), ((), 0.0))
+        return sum(counts), total
+
+    def time(self, **labels):
+        """Returns a context manager observing the time spent inside it."""
+        return _Timer(self, labels)
+
+    def render(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} {self.type}'
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, f'le="{bound}"')
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            cumulative += counts[-1]
+            labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+            yield f'{self.name}_bucket{labels} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(self.labelnames, key)} {total}'
+            yield f'{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}'
+
+
+class Registry:
+    """Holds every metric the bot exposes.
+
+    Metrics that are cheaper to read than to keep up to date can be
+    filled in by a callback registered with :meth:`on_collect`, which
+    runs right before every render.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+
+    def _register(self, cls, name, *args, **kwargs):
+        try:
+            metric = self._metrics[name]
+        except KeyError:
+            metric = self._metrics[name] = cls(name, *args, **kwargs)
+            return metric
+
+        # reloading an extension re-declares its metrics, so hand back the old one
+        if not isinstance(metric, cls):
+            raise ValueError(f'{name} is already registered as a {metric.type}')
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def on_collect(self, func):
+        """Registers ``func`` to be called before every render. Usable as a decorator."""
+        self._collectors.append(func)
+        return func
+
+    def remove_collector(self, func):
+        try:
+            self._collectors.remove(func)
+        except ValueError:
+            pass
+
+    def render(self):
+        for func in self._collectors:
+            func()
+
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        lines.append('')
+        return '\n'.join(lines)
+
+
+registry = Registry()
+
+# shared by every cog that buffers coc events before writing them out
+BUFFER_DEPTH = registry.gauge('pushbot_buffer_depth', 'Rows waiting in a cog\'s insert buffer', ('cog',))
+FLUSH_ROWS = registry.histogram('pushbot_flush_rows', 'Rows written per buffer flush', ('cog',),
+                                buckets=SIZE_BUCKETS)
+FLUSH_SECONDS = registry.histogram('pushbot_flush_seconds', 'Duration of a buffer flush', ('cog',))
+
+
+async def start_server(host='127.0.0.1', port=9100, *, registry=registry):
+    """Serves ``registry`` at ``http://host:port/metrics`` in Prometheus text format.
+
+    Returns the :class:`aiohttp.web.AppRunner` so the caller can clean it up.
+    """
+    async def handler(request):
+        return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    return runner
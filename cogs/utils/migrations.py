@@ -0,0 +1,392 @@
+"""Versioned schema migrations and EXPLAIN checks for the query catalog.
+
+Run from the repository root against a local database: ::
+
+    python -m cogs.utils.migrations upgrade postgres://localhost/pushbot
+    python -m cogs.utils.migrations seed postgres://localhost/pushbot
+    python -m cogs.utils.migrations explain postgres://localhost/pushbot
+
+``explain`` runs ``EXPLAIN (ANALYZE, BUFFERS)`` on every catalog statement
+and exits non-zero if any of them sequentially scans a large table.
+"""
+import argparse
+import asyncio
+import asyncpg
+import json
+import sys
+
+from cogs.utils.db import catalog, TimedConnection
+from cogs.utils.invalidation import TRIGGER_SQL, CLAIMS_TRIGGER_SQL
+
+# any constant works, it only has to be the same in every process
+LOCK_ID = 7291001
+
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS guilds (
+    id SERIAL PRIMARY KEY,
+    guild_id BIGINT NOT NULL UNIQUE,
+    guild_name TEXT,
+    updates_channel_id BIGINT,
+    updates_header_id BIGINT,
+    updates_toggle BOOLEAN NOT NULL DEFAULT FALSE,
+    updates_ign BOOLEAN NOT NULL DEFAULT TRUE,
+    updates_don BOOLEAN NOT NULL DEFAULT FALSE,
+    updates_rec BOOLEAN NOT NULL DEFAULT FALSE,
+    updates_tag BOOLEAN NOT NULL DEFAULT FALSE,
+    updates_claimed_by BOOLEAN NOT NULL DEFAULT FALSE,
+    updates_clan BOOLEAN NOT NULL DEFAULT FALSE,
+    log_channel_id BIGINT,
+    log_toggle BOOLEAN NOT NULL DEFAULT FALSE,
+    log_interval INTERVAL NOT NULL DEFAULT '0 minutes',
+    auto_claim BOOLEAN NOT NULL DEFAULT FALSE,
+    pushboard_title TEXT,
+    pushboard_render INTEGER NOT NULL DEFAULT 1,
+    icon_url TEXT
+);
+
+CREATE TABLE IF NOT EXISTS claims (
+    guild_id BIGINT NOT NULL,
+    clan_tag TEXT NOT NULL,
+    PRIMARY KEY (guild_id, clan_tag)
+);
+CREATE INDEX IF NOT EXISTS claims_clan_tag_idx ON claims (clan_tag);
+
+CREATE TABLE IF NOT EXISTS events (
+    event_id SERIAL PRIMARY KEY,
+    guild_id BIGINT NOT NULL,
+    event_name TEXT NOT NULL,
+    event_start_time TIMESTAMP,
+    event_end_time TIMESTAMP,
+    channel_id BIGINT,
+    log_interval INTERVAL NOT NULL DEFAULT '0 minutes',
+    log_toggle BOOLEAN NOT NULL DEFAULT FALSE
+);
+CREATE INDEX IF NOT EXISTS events_guild_id_idx ON events (guild_id);
+CREATE INDEX IF NOT EXISTS events_channel_id_idx ON events (channel_id) WHERE channel_id IS NOT NULL;
+
+CREATE TABLE IF NOT EXISTS clans (
+    clan_id SERIAL PRIMARY KEY,
+    clan_tag TEXT NOT NULL,
+    clan_name TEXT,
+    event_id INTEGER REFERENCES events (event_id) ON DELETE CASCADE,
+    guild_id BIGINT,
+    UNIQUE (event_id, clan_tag)
+);
+CREATE INDEX IF NOT EXISTS clans_clan_tag_idx ON clans (clan_tag);
+CREATE INDEX IF NOT EXISTS clans_guild_id_idx ON clans (guild_id);
+
+CREATE TABLE IF NOT EXISTS players (
+    player_id SERIAL PRIMARY KEY,
+    player_tag TEXT NOT NULL UNIQUE,
+    player_name TEXT,
+    clan_tag TEXT,
+    user_id BIGINT,
+    starting_trophies INTEGER NOT NULL DEFAULT 0,
+    current_trophies INTEGER NOT NULL DEFAULT 0,
+    starting_attack_wins INTEGER NOT NULL DEFAULT 0,
+    current_attack_wins INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS players_clan_tag_idx ON players (clan_tag);
+
+CREATE TABLE IF NOT EXISTS coc_events (
+    coc_event_id BIGSERIAL PRIMARY KEY,
+    player_tag TEXT NOT NULL,
+    player_name TEXT,
+    clan_tag TEXT,
+    clan_name TEXT,
+    trophy_change INTEGER NOT NULL,
+    time_stamp TIMESTAMP NOT NULL,
+    reported BOOLEAN NOT NULL DEFAULT FALSE
+);
+-- recent player / recent clan, newest first
+CREATE INDEX IF NOT EXISTS coc_events_player_tag_idx ON coc_events (player_tag, time_stamp DESC);
+CREATE INDEX IF NOT EXISTS coc_events_clan_tag_idx ON coc_events (clan_tag, time_stamp DESC);
+-- the report loop only ever looks at the unreported tail
+CREATE INDEX IF NOT EXISTS coc_events_unreported_idx ON coc_events (clan_tag) WHERE NOT reported;
+
+CREATE TABLE IF NOT EXISTS messages (
+    id SERIAL PRIMARY KEY,
+    guild_id BIGINT NOT NULL,
+    message_id BIGINT NOT NULL UNIQUE,
+    channel_id BIGINT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_guild_id_idx ON messages (guild_id);
+CREATE INDEX IF NOT EXISTS messages_channel_id_idx ON messages (channel_id);
+
+CREATE TABLE IF NOT EXISTS log_timers (
+    id SERIAL PRIMARY KEY,
+    channel_id BIGINT NOT NULL,
+    fmt TEXT NOT NULL,
+    expires TIMESTAMP NOT NULL
+);
+CREATE INDEX IF NOT EXISTS log_timers_expires_idx ON log_timers (expires);
+"""
+
+# trophy changes found by the polling workers, drained by the bot
+POLL_QUEUE_SQL = """
+CREATE TABLE IF NOT EXISTS poll_events (
+    id BIGSERIAL PRIMARY KEY,
+    player_tag TEXT NOT NULL,
+    player_name TEXT,
+    clan_tag TEXT,
+    clan_name TEXT,
+    old_trophies INTEGER NOT NULL,
+    new_trophies INTEGER NOT NULL,
+    polled_at TIMESTAMP NOT NULL,
+    claimed_at TIMESTAMP
+);
+"""
+
+# a queued trophy change can be handled twice, so applying it must be idempotent
+REPLAY_SQL = """
+ALTER TABLE players ADD COLUMN IF NOT EXISTS trophies_at TIMESTAMP;
+ALTER TABLE coc_events ADD COLUMN IF NOT EXISTS poll_event_id BIGINT;
+CREATE UNIQUE INDEX IF NOT EXISTS coc_events_poll_event_id_idx ON coc_events (poll_event_id)
+    WHERE poll_event_id IS NOT NULL;
+"""
+
+
+class Migration:
+    __slots__ = ('version', 'description', 'sql')
+
+    def __init__(self, version, description, sql):
+        self.version = version
+        self.description = description
+        self.sql = sql
+
+    def __repr__(self):
+        return f'<Migration version={self.version} description={self.description!r}>'
+
+
+# append only, never edit a migration that has shipped
+migrations = [
+    Migration(1, 'tables and indexes', SCHEMA_SQL),
+    Migration(2, 'cache invalidation triggers', TRIGGER_SQL),
+    Migration(3, 'claims invalidation trigger', CLAIMS_TRIGGER_SQL),
+    Migration(4, 'polling worker queue', POLL_QUEUE_SQL),
+    Migration(5, 'idempotent trophy changes', REPLAY_SQL),
+]
+
+
+async def current_version(connection):
+    await connection.execute("CREATE TABLE IF NOT EXISTS schema_migrations ("
+                             "version INTEGER PRIMARY KEY, "
+                             "description TEXT NOT NULL, "
+                             "applied_at TIMESTAMP NOT NULL DEFAULT (now() at time zone 'utc'))")
+    return await connection.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+
+
+async def migrate(connection, target=None):
+    """Applies every pending migration up to ``target``, each in its own transaction.
+
+    Returns the migrations that were applied. An advisory lock keeps two
+    processes starting at once from racing each other.
+    """
+    applied = []
+    await connection.execute("SELECT pg_advisory_lock($1)", LOCK_ID)
+    try:
+        version = await current_version(connection)
+        for migration in migrations:
+            if migration.version <= version:
+                continue
+            if target is not None and migration.version > target:
+                break
+            async with connection.transaction():
+                await connection.execute(migration.sql)
+                await connection.execute("INSERT INTO schema_migrations (version, description) VALUES ($1, $2)",
+                                         migration.version, migration.description)
+            applied.append(migration)
+    finally:
+        await connection.execute("SELECT pg_advisory_unlock($1)", LOCK_ID)
+    return applied
+
+
+async def upgrade(dsn, target=None):
+    connection = await asyncpg.connect(dsn)
+    try:
+        return await migrate(connection, target)
+    finally:
+        await connection.close()
+
+
+# -- seeding
+
+SEED_STATEMENTS = (
+    ("INSERT INTO guilds (guild_id, guild_name) "
+     "SELECT g, 'guild ' || g FROM generate_series(1, $1::INTEGER) g", ('guilds',)),
+    ("INSERT INTO events (guild_id, event_name, event_start_time, event_end_time, channel_id, log_toggle) "
+     "SELECT guild_id, 'event ' || guild_id, now() - interval '1 day', now() + interval '6 days', "
+     "1000000 + guild_id, TRUE FROM guilds", ()),
+    ("INSERT INTO clans (clan_tag, clan_name, event_id, guild_id) "
+     "SELECT '#C' || (e.event_id * 1000 + n), 'clan ' || n, e.event_id, e.guild_id "
+     "FROM events e, generate_series(1, $1::INTEGER) n", ('clans_per_guild',)),
+    ("INSERT INTO claims (guild_id, clan_tag) SELECT guild_id, clan_tag FROM clans", ()),
+    ("INSERT INTO players (player_tag, player_name, clan_tag, starting_trophies, current_trophies, "
+     "starting_attack_wins, current_attack_wins) "
+     "SELECT c.clan_tag || 'P' || n, 'player ' || n, c.clan_tag, 4000, 4000 + (random() * 1000)::INTEGER, "
+     "0, (random() * 50)::INTEGER FROM clans c, generate_series(1, $1::INTEGER) n", ('players_per_clan',)),
+    ("INSERT INTO coc_events (player_tag, player_name, clan_tag, clan_name, trophy_change, time_stamp, reported) "
+     "SELECT p.player_tag, p.player_name, p.clan_tag, 'clan', (random() * 60 - 30)::INTEGER, "
+     "now() - random() * interval '7 days', random() > 0.01 "
+     "FROM players p, generate_series(1, $1::INTEGER)", ('events_per_player',)),
+    ("INSERT INTO messages (guild_id, message_id, channel_id) "
+     "SELECT guild_id, event_id * 10 + n, channel_id FROM events, generate_series(1, 2) n", ()),
+    ("INSERT INTO log_timers (channel_id, fmt, expires) "
+     "SELECT channel_id, 'seeded log', now() + random() * interval '1 hour' FROM events", ()),
+)
+
+
+async def seed(connection, *, guilds=50, clans_per_guild=4, players_per_clan=50, events_per_player=20,
+               random_seed=0.5):
+    """Fills an empty, migrated database with synthetic data and analyzes it.
+
+    The defaults give 10k players and 200k coc_events. The same
+    ``random_seed`` always produces the same data.
+    """
+    if await connection.fetchval("SELECT EXISTS (SELECT 1 FROM guilds)"):
+        raise RuntimeError("refusing to seed a database that already has guilds")
+    params = {'guilds': guilds, 'clans_per_guild': clans_per_guild,
+              'players_per_clan': players_per_clan, 'events_per_player': events_per_player}
+    async with connection.transaction():
+        await connection.execute("SELECT setseed($1)", random_seed)
+        for sql, names in SEED_STATEMENTS:
+            await connection.execute(sql, *(params[n] for n in names))
+    await connection.execute("ANALYZE")
+
+
+# -- EXPLAIN checks
+
+# one row of arguments for each catalog statement that takes any
+SAMPLE_ARGS = {
+    'guild_config': "SELECT guild_id FROM guilds LIMIT 1",
+    'guild_clan_tags': "SELECT guild_id FROM clans LIMIT 1",
+    'guilds_for_clans': "SELECT array_agg(clan_tag) FROM (SELECT clan_tag FROM clans LIMIT 10) c",
+    'claims_for_clan': "SELECT clan_tag FROM claims LIMIT 1",
+    'clan_players': "SELECT clan_tag FROM players LIMIT 1",
+    'insert_players': "SELECT jsonb_agg(jsonb_build_object('player_tag', player_tag || 'X', 'player_name', player_name, "
+                      "'clan_tag', clan_tag, 'trophies', current_trophies)) FROM (SELECT * FROM players LIMIT 50) p",
+    'delete_clan_players': "SELECT clan_tag FROM players LIMIT 1",
+    'enqueue_poll_events': "SELECT jsonb_agg(jsonb_build_object('player_tag', player_tag, 'player_name', player_name, "
+                           "'clan_tag', clan_tag, 'clan_name', 'clan', 'old_trophies', current_trophies, "
+                           "'new_trophies', current_trophies + 5, 'polled_at', now()::TIMESTAMP)) "
+                           "FROM (SELECT * FROM players LIMIT 50) p",
+    'claim_poll_events': "SELECT 500, 600.0::FLOAT8",
+    'ack_poll_events': "SELECT array_agg(id) FROM (SELECT id FROM poll_events LIMIT 500) p",
+    'leaderboard_players': "SELECT array_agg(player_tag) FROM (SELECT player_tag FROM players LIMIT 50) p",
+    'apply_trophy_changes': "SELECT jsonb_agg(jsonb_build_object('player_tag', player_tag, "
+                            "'trophies', current_trophies + 5, 'time_stamp', now()::TIMESTAMP)) "
+                            "FROM (SELECT player_tag, current_trophies FROM players LIMIT 50) p",
+    'guild_messages': "SELECT guild_id FROM messages LIMIT 1",
+    'message': "SELECT message_id FROM messages LIMIT 1",
+    'insert_message': "SELECT 1::BIGINT, 2::BIGINT, 3::BIGINT",
+    'delete_message': "SELECT message_id FROM messages LIMIT 1",
+    'insert_coc_events': "SELECT jsonb_agg(jsonb_build_object('player_tag', player_tag, 'player_name', player_name, "
+                         "'clan_tag', clan_tag, 'clan_name', 'clan', 'trophy_change', 5, "
+                         "'time_stamp', now()::TIMESTAMP)) FROM (SELECT * FROM players LIMIT 50) p",
+    'unreported_events': "SELECT channel_id FROM events WHERE channel_id IS NOT NULL LIMIT 1",
+    'channel_config': "SELECT channel_id FROM events WHERE channel_id IS NOT NULL LIMIT 1",
+    'channel_configs': "SELECT array_agg(channel_id) FROM (SELECT channel_id FROM events LIMIT 10) e",
+    'insert_log_timer': "SELECT 1::BIGINT, 'log', now()::TIMESTAMP",
+    'delete_log_timer': "SELECT id FROM log_timers LIMIT 1",
+    'recent_guild': "SELECT guild_id, 20 FROM events LIMIT 1",
+    'recent_player': "SELECT player_tag, 20 FROM coc_events LIMIT 1",
+    'recent_clans': "SELECT array_agg(clan_tag), 20 FROM (SELECT clan_tag FROM clans LIMIT 4) c",
+}
+
+# statements that read a whole table by design
+FULL_SCANS = {'all_players', 'all_claims'}
+
+
+def _walk(plan):
+    yield plan
+    for child in plan.get('Plans', ()):
+        yield from _walk(child)
+
+
+class ExplainResult:
+    __slots__ = ('name', 'seq_scans', 'cost', 'milliseconds', 'shared_read')
+
+    def __init__(self, name, seq_scans, cost, milliseconds=None, shared_read=None):
+        self.name = name
+        self.seq_scans = seq_scans
+        self.cost = cost
+        self.milliseconds = milliseconds
+        self.shared_read = shared_read
+
+    @property
+    def ok(self):
+        return not self.seq_scans or self.name in FULL_SCANS
+
+
+async def explain_catalog(connection, *, min_rows=10000, analyze=True):
+    """Runs ``EXPLAIN (ANALYZE, BUFFERS)`` on every catalog statement.
+
+    Writes are rolled back, but they still run and take their locks, so only
+    analyze a seeded copy. With ``analyze=False`` only the read statements are
+    planned, with a plain ``EXPLAIN`` that executes nothing, and
+    ``milliseconds``/``shared_read`` are left unset.
+
+    Returns an :class:`ExplainResult` per statement whose ``seq_scans`` lists
+    the tables over ``min_rows`` rows it scanned sequentially.
+    """
+    await connection.set_type_codec('jsonb', encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
+    sizes = dict(await connection.fetch("SELECT relname, reltuples FROM pg_class WHERE relkind = 'r'"))
+    results = []
+    explain = "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON)" if analyze else "EXPLAIN (FORMAT JSON)"
+    for q in catalog.values():
+        if not analyze and q.kind != 'read':
+            continue
+        args = ()
+        if q.name in SAMPLE_ARGS:
+            row = await connection.fetchrow(SAMPLE_ARGS[q.name])
+            if row is None:
+                raise RuntimeError(f"no sample arguments for {q.name}, is the database seeded?")
+            args = tuple(row)
+        tr = connection.transaction()
+        await tr.start()
+        try:
+            raw = await connection.fetchval(f"{explain} {q.sql}", *args)
+        finally:
+            await tr.rollback()
+        plan = (json.loads(raw) if isinstance(raw, str) else raw)[0]
+        seq_scans = sorted({node['Relation Name'] for node in _walk(plan['Plan'])
+                            if node['Node Type'] == 'Seq Scan'
+                            and sizes.get(node['Relation Name'], 0) >= min_rows})
+        if analyze:
+            results.append(ExplainResult(q.name, seq_scans, plan['Plan']['Total Cost'], plan['Execution Time'],
+                                         plan['Plan'].get('Shared Read Blocks', 0)))
+        else:
+            results.append(ExplainResult(q.name, seq_scans, plan['Plan']['Total Cost']))
+    return results
+
+
+async def _main(args):
+    connection = await asyncpg.connect(args.dsn, connection_class=TimedConnection)
+    try:
+        if args.command == 'upgrade':
+            for migration in await migrate(connection, args.target):
+                print(f'applied {migration.version}: {migration.description}')
+            print(f'at version {await current_version(connection)}')
+        elif args.command == 'seed':
+            await migrate(connection)
+            await seed(connection)
+            print('seeded')
+        else:
+            failed = False
+            for result in await explain_catalog(connection, min_rows=args.min_rows):
+                verdict = 'ok' if result.ok else 'SEQ SCAN ' + ', '.join(result.seq_scans)
+                print(f'{result.name:<24} {result.milliseconds:>10.2f} ms {result.shared_read:>8} read  {verdict}')
+                failed = failed or not result.ok
+            return 1 if failed else 0
+    finally:
+        await connection.close()
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m cogs.utils.migrations')
+    parser.add_argument('command', choices=('upgrade', 'seed', 'explain'))
+    parser.add_argument('dsn')
+    parser.add_argument('--target', type=int, default=None, help='upgrade no further than this version')
+    parser.add_argument('--min-rows', type=int, default=10000, help='tables this big must not be seq scanned')
+    sys.exit(asyncio.get_event_loop().run_until_complete(_main(parser.parse_args())))
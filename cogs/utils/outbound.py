@@ -0,0 +1,203 @@
+import asyncio
+import enum
+import functools
+import heapq
+import itertools
+import time
+
+from collections import Counter
+
+# Discord allows 50 requests per second globally and roughly 5 messages
+# per 5 seconds per channel. We stay a little under both so discord.py's
+# own 429 handling stays the exception rather than the rule.
+GLOBAL_RATE = 45.0
+GLOBAL_BURST = 45
+CHANNEL_RATE = 1.0
+CHANNEL_BURST = 5
+
+
+class Priority(enum.IntEnum):
+    interactive = 0
+    log = 1
+    background = 2
+
+
+class TokenBucket:
+    """A token bucket refilled with ``rate`` tokens per second up to ``capacity``."""
+    __slots__ = ('rate', 'capacity', '_tokens', '_last')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._last = time.monotonic()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def delay(self):
+        """Returns how many seconds until a token is available, ``0.0`` if one is available now."""
+        self._refill(time.monotonic())
+        if self._tokens >= 1:
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    def consume(self):
+        self._tokens -= 1
+
+    @property
+    def full(self):
+        self._refill(time.monotonic())
+        return self._tokens >= self.capacity
+
+
+class _Entry:
+    __slots__ = ('priority', 'seq', 'channel_id', 'factory', 'future', 'queued_at')
+
+    def __init__(self, priority, seq, channel_id, factory, future):
+        self.priority = priority
+        self.seq = seq
+        self.channel_id = channel_id
+        self.factory = factory
+        self.future = future
+        self.queued_at = time.monotonic()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class OutboundQueue:
+    """Central queue for everything the bot sends to Discord.
+
+    Requests are released in priority order while respecting a global
+    token bucket and one token bucket per channel. A channel that runs out
+    of tokens is parked until it refills so it never holds up the others.
+
+    Parameters
+    -----------
+    loop: asyncio.AbstractEventLoop
+        The loop to run the dispatcher on.
+    max_depth: int
+        How many requests may be waiting at once. Non-interactive
+        requests beyond this are rejected with :exc:`asyncio.QueueFull`.
+    """
+
+    def __init__(self, *, loop=None, max_depth=1000, global_rate=GLOBAL_RATE, global_burst=GLOBAL_BURST,
+                 channel_rate=CHANNEL_RATE, channel_burst=CHANNEL_BURST):
+        self.loop = loop or asyncio.get_event_loop()
+        self.max_depth = max_depth
+        self.channel_rate = channel_rate
+        self.channel_burst = channel_burst
+        self.stats = Counter()
+        self.wait_seconds = Counter()
+
+        self._global = TokenBucket(global_rate, global_burst)
+        self._buckets = {}
+        self._ready = []
+        self._parked = {}
+        self._depth = 0
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event(loop=self.loop)
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = self.loop.create_task(self._dispatcher())
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    @property
+    def depth(self):
+        return self._depth
+
+    def _bucket(self, channel_id):
+        try:
+            return self._buckets[channel_id]
+        except KeyError:
+            pass
+
+        if len(self._buckets) > 5000:
+            # idle buckets are full buckets, so forgetting them changes nothing
+            for key in [k for k, b in self._buckets.items() if b.full and k not in self._parked]:
+                del self._buckets[key]
+
+        bucket = self._buckets[channel_id] = TokenBucket(self.channel_rate, self.channel_burst)
+        return bucket
+
+    def submit(self, channel_id, factory, *, priority=Priority.log):
+        """Queues ``factory``, a coroutine function taking no arguments.
+
+        Returns a future resolving to whatever the coroutine returns.
+        """
+        if self._depth >= self.max_depth and priority is not Priority.interactive:
+            self.stats['dropped'] += 1
+            raise asyncio.QueueFull()
+
+        future = self.loop.create_future()
+        heapq.heappush(self._ready, _Entry(priority, next(self._seq), channel_id, factory, future))
+        self._depth += 1
+        self.stats['enqueued'] += 1
+        self._wakeup.set()
+        return future
+
+    async def send(self, channel, *, priority=Priority.log, **kwargs):
+        """Queues ``channel.send(**kwargs)`` and waits for the resulting message."""
+        return await self.submit(channel.id, functools.partial(channel.send, **kwargs), priority=priority)
+
+    def _unpark(self, channel_id):
+        for entry in self._parked.pop(channel_id, ()):
+            heapq.heappush(self._ready, entry)
+        self._wakeup.set()
+
+    async def _dispatcher(self):
+        while True:
+            await self._wakeup.wait()
+            while self._ready:
+                wait = self._global.delay()
+                if wait:
+                    self.stats['global_throttled'] += 1
+                    await asyncio.sleep(wait)
+                    continue
+
+                entry = heapq.heappop(self._ready)
+                if entry.future.cancelled():
+                    self._depth -= 1
+                    self.stats['cancelled'] += 1
+                    continue
+
+                channel_id = entry.channel_id
+                if channel_id in self._parked:
+                    # keep the channel's messages in order behind the parked one
+                    heapq.heappush(self._parked[channel_id], entry)
+                    continue
+
+                bucket = self._bucket(channel_id)
+                wait = bucket.delay()
+                if wait:
+                    self.stats['channel_throttled'] += 1
+                    self._parked[channel_id] = [entry]
+                    self.loop.call_later(wait, self._unpark, channel_id)
+                    continue
+
+                bucket.consume()
+                self._global.consume()
+                self._depth -= 1
+                self.wait_seconds[entry.priority.name] += time.monotonic() - entry.queued_at
+                self.loop.create_task(self._send(entry))
+            self._wakeup.clear()
+
+    async def _send(self, entry):
+        try:
+            result = await entry.factory()
+        except Exception as e:
+            self.stats['failed'] += 1
+            if not entry.future.done():
+                entry.future.set_exception(e)
+        else:
+            self.stats['sent'] += 1
+            if not entry.future.done():
+                entry.future.set_result(result)
@@ -0,0 +1,371 @@
+import asyncio
+import coc
+import heapq
+import time
+import zlib
+
+from collections import defaultdict, deque
+
+from loguru import logger
+
+from . import cocapi, metrics
+
+DETECTION_BUCKETS = (1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0, 3600.0)
+
+DETECTION_LATENCY = metrics.registry.histogram('pushbot_poll_detection_seconds',
+                                               'Time between the last poll before a trophy change and the poll '
+                                               'that saw it', buckets=DETECTION_BUCKETS)
+POLLS = metrics.registry.counter('pushbot_polls_total', 'Player polls by outcome', ('outcome',))
+SCHEDULED = metrics.registry.gauge('pushbot_poll_scheduled_players', 'Players of running events being polled')
+OVERDUE = metrics.registry.gauge('pushbot_poll_overdue_seconds', 'How far behind schedule the last poll started')
+SWEEP_SECONDS = metrics.registry.histogram('pushbot_poll_sweep_seconds',
+                                           'Time taken to poll every scheduled player at least once',
+                                           buckets=DETECTION_BUCKETS)
+BUDGET_WAIT = metrics.registry.histogram('pushbot_poll_budget_wait_seconds',
+                                         'Time a due poll waited for the request budget')
+POLL_RATE = metrics.registry.gauge('pushbot_poll_requests_per_second', 'Player polls a second over the last minute')
+STALENESS = metrics.registry.gauge('pushbot_poll_staleness_seconds',
+                                   'Age of the newest data held for scheduled players', ('quantile',))
+
+STALENESS_QUANTILES = (50, 90, 99, 100)
+
+
+def shard_of(player_tag, count):
+    """The polling worker, out of ``count``, that owns ``player_tag``."""
+    return zlib.crc32(player_tag.encode()) % count
+
+
+class PlayerRegistry:
+    """The set of player tags that can be polled, and the clan each was added under.
+
+    The ``players`` table is read once at startup. After that the set only
+    changes by deltas: the rows ``add``/``remove`` insert or delete, members
+    who join a tracked clan, and a clan reload when another process publishes
+    ``players`` on the :class:`~cogs.utils.invalidation.InvalidationBus`.
+
+    Iterating the registry yields a snapshot, so a command can't change it
+    under a sweep that awaits between players.
+
+    A polling worker passes ``shard=(index, count)`` and only keeps the tags
+    :func:`shard_of` assigns to it.
+    """
+
+    def __init__(self, *, shard=None):
+        self._clans = {}
+        self._players = defaultdict(set)
+        self.shard = shard
+        self.loaded = False
+
+    def __len__(self):
+        return len(self._clans)
+
+    def __contains__(self, player_tag):
+        return player_tag in self._clans
+
+    def __iter__(self):
+        return iter(tuple(self._clans))
+
+    def players_for(self, clan_tag):
+        """The tags of the polled players added under ``clan_tag``."""
+        return frozenset(self._players.get(clan_tag, ()))
+
+    def add(self, player_tag, clan_tag=None):
+        if self.shard is not None and shard_of(player_tag, self.shard[1]) != self.shard[0]:
+            return
+        if player_tag in self._clans and self._clans[player_tag] != clan_tag:
+            self._unlink(player_tag, self._clans[player_tag])
+        self._clans[player_tag] = clan_tag
+        self._players[clan_tag].add(player_tag)
+
+    def discard(self, player_tag):
+        if player_tag in self._clans:
+            self._unlink(player_tag, self._clans.pop(player_tag))
+
+    def _unlink(self, player_tag, clan_tag):
+        tags = self._players[clan_tag]
+        tags.discard(player_tag)
+        if not tags:
+            del self._players[clan_tag]
+
+    def add_many(self, records):
+        """Adds ``(player_tag, clan_tag)`` rows, as returned by ``insert_players``."""
+        for player_tag, clan_tag in records:
+            self.add(player_tag, clan_tag)
+
+    def discard_many(self, player_tags):
+        for player_tag in player_tags:
+            self.discard(player_tag)
+
+    def clear(self):
+        self._clans.clear()
+        self._players.clear()
+
+    async def load(self, db):
+        fetch = await db.fetch("all_players", fresh=True)
+        self.clear()
+        self.add_many(fetch)
+        self.loaded = True
+        logger.info(f"Polling {len(self)} players")
+
+    async def reload_clan(self, db, clan_tag):
+        fetch = await db.fetch("clan_players", clan_tag, fresh=True)
+        self.discard_many(self.players_for(clan_tag))
+        for (player_tag,) in fetch:
+            self.add(player_tag, clan_tag)
+
+    async def sync_roster(self, db, clan):
+        """Starts polling members who joined ``clan`` since it was added.
+
+        Members who left stay in the set, so a push made before leaving still
+        counts until the clan is removed from the event.
+        """
+        joined = [{"player_tag": n.tag, "player_name": n.name, "clan_tag": clan.tag, "trophies": n.trophies}
+                  for n in clan.itermembers if n.tag not in self]
+        if not joined:
+            return []
+        fetch = await db.fetch("insert_players", joined)
+        self.add_many(fetch)
+        return fetch
+
+
+class _PlayerState:
+    __slots__ = ('trophies', 'polled', 'changed', 'due', 'sweep')
+
+    def __init__(self, now):
+        self.trophies = None
+        self.polled = None
+        self.changed = now
+        self.due = now
+        self.sweep = -1
+
+
+def percentile(values, p):
+    """The ``p``-th percentile of the already sorted ``values``."""
+    index = min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))
+    return values[index]
+
+
+class PollStats:
+    """Running totals for the ``poll_stats`` command; the metrics carry the same numbers."""
+    __slots__ = ('polls', 'changes', 'errors', 'budget_wait', 'sweeps', 'last_sweep', 'started')
+
+    def __init__(self):
+        self.polls = 0
+        self.changes = 0
+        self.errors = 0
+        self.budget_wait = 0.0
+        self.sweeps = 0
+        self.last_sweep = None
+        self.started = time.monotonic()
+
+
+class PollScheduler:
+    """Polls the players of running events, busy players more often than idle ones.
+
+    This replaces ``EventsClient.start_updates("player")``, which sweeps every
+    tag in ``_player_updates`` at the same rate. Each player gets its own
+    interval, ``activity_factor`` times how long ago its trophies last moved,
+    clamped to ``min_interval``/``max_interval``. Due players are polled in
+    order, never faster than ``budget`` requests a second, and a change is
+    dispatched as ``on_player_trophies_change`` just as coc.py would.
+
+    Which clans have a running event is re-read every ``refresh_interval``
+    seconds; players of other clans keep their place in the registry but
+    aren't polled.
+    """
+
+    def __init__(self, bot, players, *, budget=30.0, min_interval=30.0, max_interval=1800.0,
+                 activity_factor=0.1, refresh_interval=60.0, max_in_flight=40):
+        self.bot = bot
+        self.players = players
+        self.budget = budget
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.activity_factor = activity_factor
+        self.refresh_interval = refresh_interval
+        self._states = {}
+        self._heap = []
+        self._tokens = budget
+        self._filled = time.monotonic()
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self._next_refresh = 0.0
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._recent = deque()
+        self._sweep = 0
+        self._swept = 0
+        self._sweep_started = time.monotonic()
+        self.stats = PollStats()
+
+    def __len__(self):
+        return len(self._states)
+
+    @property
+    def requests_per_second(self):
+        now = time.monotonic()
+        while self._recent and self._recent[0] < now - 60:
+            self._recent.popleft()
+        return len(self._recent) / min(60.0, max(1.0, now - self.stats.started))
+
+    def staleness(self):
+        """Seconds since each scheduled player was last polled successfully, sorted."""
+        now = time.monotonic()
+        return sorted(now - (n.polled or n.changed) for n in self._states.values())
+
+    def collect_metrics(self):
+        POLL_RATE.set(self.requests_per_second)
+        ages = self.staleness()
+        for q in STALENESS_QUANTILES:
+            STALENESS.set(percentile(ages, q) if ages else 0, quantile=str(q / 100))
+
+    def _attempted(self, tag, state):
+        """Books a poll, successful or not, towards the rate and the current sweep."""
+        now = time.monotonic()
+        self._recent.append(now)
+        self.stats.polls += 1
+        # a player dropped while its poll was in flight isn't part of any sweep
+        if state.sweep == self._sweep or self._states.get(tag) is not state:
+            return
+        state.sweep = self._sweep
+        self._swept += 1
+        self._check_sweep(now)
+
+    def _check_sweep(self, now):
+        if self._swept < len(self._states) or not self._states:
+            return
+        self.stats.last_sweep = now - self._sweep_started
+        self.stats.sweeps += 1
+        SWEEP_SECONDS.observe(self.stats.last_sweep)
+        self._sweep += 1
+        self._swept = 0
+        self._sweep_started = now
+
+    def interval_for(self, state, now):
+        idle = now - state.changed
+        return min(self.max_interval, max(self.min_interval, idle * self.activity_factor))
+
+    def _schedule(self, tag, state, due):
+        state.due = due
+        heapq.heappush(self._heap, (due, tag))
+        self._wakeup.set()
+
+    async def refresh(self):
+        """Starts polling players whose event began and stops those whose event ended."""
+        running = await self.bot.db.fetch("running_clans", fresh=True)
+        active = set()
+        for (clan_tag,) in running:
+            active.update(self.players.players_for(clan_tag))
+        now = time.monotonic()
+        if not self._states:
+            # nothing was being swept while the set was empty
+            self._sweep_started = now
+        for tag in active.difference(self._states):
+            state = self._states[tag] = _PlayerState(now)
+            self._schedule(tag, state, now)
+        for tag in set(self._states).difference(active):
+            # its heap entry is skipped when it comes up
+            if self._states.pop(tag).sweep == self._sweep:
+                self._swept -= 1
+        self._check_sweep(now)
+        SCHEDULED.set(len(self._states))
+        if len(self._heap) > 2 * len(self._states) + 1000:
+            self._heap = [(n.due, tag) for tag, n in self._states.items()]
+            heapq.heapify(self._heap)
+
+    async def _take_token(self):
+        started = time.monotonic()
+        try:
+            await self._wait_for_token()
+        finally:
+            waited = time.monotonic() - started
+            self.stats.budget_wait += waited
+            BUDGET_WAIT.observe(waited)
+
+    async def _wait_for_token(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.budget, self._tokens + (now - self._filled) * self.budget)
+            self._filled = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.budget)
+
+    async def _poll(self, tag, state):
+        try:
+            with cocapi.uncached():
+                player = await self.bot.coc.get_player(tag)
+        except coc.NotFound:
+            POLLS.inc(outcome="not_found")
+            self._schedule(tag, state, time.monotonic() + self.max_interval)
+            return
+        except (coc.ClashOfClansException, asyncio.TimeoutError):
+            POLLS.inc(outcome="error")
+            self.stats.errors += 1
+            self._schedule(tag, state, time.monotonic() + self.min_interval)
+            return
+        except Exception:
+            # anything else would leave the player in _states with no heap entry
+            logger.exception(f"Polling {tag} failed")
+            POLLS.inc(outcome="error")
+            self.stats.errors += 1
+            self._schedule(tag, state, time.monotonic() + self.min_interval)
+            return
+        finally:
+            self._in_flight.release()
+            self._attempted(tag, state)
+
+        now = time.monotonic()
+        old_trophies = state.trophies
+        if old_trophies is not None and player.trophies != old_trophies:
+            # the change happened some time after the previous poll
+            DETECTION_LATENCY.observe(now - state.polled)
+            state.changed = now
+            self.stats.changes += 1
+            POLLS.inc(outcome="changed")
+            self.bot.coc.dispatch("on_player_trophies_change", old_trophies, player.trophies, player)
+        else:
+            POLLS.inc(outcome="unchanged")
+        state.trophies = player.trophies
+        state.polled = now
+        if self._states.get(tag) is state:
+            self._schedule(tag, state, now + self.interval_for(state, now))
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            if now >= self._next_refresh:
+                try:
+                    await self.refresh()
+                except Exception:
+                    logger.exception("Could not refresh the running events, polling the previous set")
+                self._next_refresh = now + self.refresh_interval
+            if not self._heap or self._heap[0][0] > now:
+                OVERDUE.set(0)
+                wake = self._heap[0][0] if self._heap else self._next_refresh
+                self._wakeup.clear()
+                try:
+                    # a poll finishing can schedule a player sooner than ``wake``
+                    await asyncio.wait_for(self._wakeup.wait(), max(0.0, min(wake, self._next_refresh) - now))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            due, tag = heapq.heappop(self._heap)
+            state = self._states.get(tag)
+            if state is None or state.due != due:
+                continue
+            OVERDUE.set(now - due)
+            await self._take_token()
+            await self._in_flight.acquire()
+            self.bot.loop.create_task(self._poll(tag, state))
+
+    def start(self):
+        if self._task is None:
+            metrics.registry.on_collect(self.collect_metrics)
+            self._task = self.bot.loop.create_task(self._run())
+
+    def close(self):
+        if self._task is not None:
+            metrics.registry.remove_collector(self.collect_metrics)
+            self._task.cancel()
+            self._task = None
@@ -0,0 +1,301 @@
+"""Optional multi-process player polling.
+
+With a ``poll_workers`` section in config the bot doesn't poll players
+itself. It starts one worker process per entry in ``key_names``, and each
+worker polls the players :func:`~cogs.utils.polling.shard_of` assigns to it
+with its own coc client and key set. Trophy changes are written to the
+``poll_events`` table and announced with ``NOTIFY``; the bot drains the table
+and replays every row as ``on_player_trophies_change``, so the handlers
+don't know which mode they run in. ::
+
+    "poll_workers": {"key_names": ["pushbot-poll-0", "pushbot-poll-1"],
+                     "metrics_ports": [9101, 9102]}
+
+A worker only serves metrics if ``metrics_ports`` gives it a port.
+
+A worker can also be run by hand: ::
+
+    python -m cogs.utils.workers 0
+"""
+import asyncio
+import asyncpg
+import coc
+import sys
+
+from datetime import datetime
+
+from loguru import logger
+
+from . import cocapi, metrics
+from .db import PushDB
+from .invalidation import InvalidationBus
+from .polling import PlayerRegistry, PollScheduler
+
+CHANNEL = 'pushbot_poll'
+
+QUEUE_LAG = metrics.registry.histogram('pushbot_poll_queue_seconds',
+                                       'Time from a worker seeing a trophy change to the bot handling it')
+QUEUE_EVENTS = metrics.registry.counter('pushbot_poll_queue_events_total',
+                                        'Trophy changes passed through the worker queue', ('stage',))
+
+
+class ClanSnapshot:
+    __slots__ = ('tag', 'name')
+
+    def __init__(self, tag, name):
+        self.tag = tag
+        self.name = name
+
+
+class PlayerSnapshot:
+    """The parts of a polled player the trophy handlers read, rebuilt from a ``poll_events`` row.
+
+    ``poll_event_id`` and ``polled_at`` let the handlers write a row that is
+    handled twice only once, with the time the worker saw the change.
+    """
+    __slots__ = ('tag', 'name', 'trophies', 'clan', 'poll_event_id', 'polled_at')
+
+    def __init__(self, record):
+        self.poll_event_id = record['id']
+        self.polled_at = record['polled_at']
+        self.tag = record['player_tag']
+        self.name = record['player_name']
+        self.trophies = record['new_trophies']
+        self.clan = ClanSnapshot(record['clan_tag'], record['clan_name']) if record['clan_tag'] else None
+
+
+def polled_at(player):
+    """When ``player`` was polled: the worker's time for a replayed row, otherwise now."""
+    return getattr(player, 'polled_at', None) or datetime.utcnow()
+
+
+class PollQueue:
+    """Drains ``poll_events`` in the bot.
+
+    Rows are claimed with ``FOR UPDATE SKIP LOCKED``, so several bot
+    processes can drain the same table without handling a change twice, and
+    are only deleted once every handler that buffers them has written them to
+    the database. The handlers call :meth:`flushed` after each write. A batch
+    waits for two writes per buffer, because its handlers can still be queued
+    behind the first one. Rows whose claim is older than ``lease`` seconds,
+    left behind by a process that died before acknowledging them, are claimed
+    again.
+    """
+
+    def __init__(self, bot, *, batch_size=500, idle_interval=5.0, lease=600.0):
+        self.bot = bot
+        self.batch_size = batch_size
+        self.idle_interval = idle_interval
+        self.lease = lease
+        self._buffers = set()
+        # [row ids, {buffer: writes still to wait for}]
+        self._pending = []
+        self._wakeup = asyncio.Event()
+        self._connection = None
+        self._task = None
+
+    def register_buffer(self, name):
+        self._buffers.add(name)
+
+    def unregister_buffer(self, name):
+        self._buffers.discard(name)
+        for _, waiting in self._pending:
+            waiting.pop(name, None)
+        self._wakeup.set()
+
+    def flushed(self, name):
+        """Called by a buffering handler after it wrote its batch to the database."""
+        for _, waiting in self._pending:
+            if name in waiting:
+                waiting[name] -= 1
+                if not waiting[name]:
+                    del waiting[name]
+                    self._wakeup.set()
+
+    async def acknowledge(self):
+        done = [ids for ids, waiting in self._pending if not waiting]
+        if not done:
+            return
+        self._pending = [n for n in self._pending if n[1]]
+        ids = [n for batch in done for n in batch]
+        try:
+            await self.bot.db.execute("ack_poll_events", ids)
+        except Exception:
+            self._pending.append((ids, {}))
+            raise
+        QUEUE_EVENTS.inc(len(ids), stage="acknowledged")
+
+    def start(self, dsn):
+        if self._task is None:
+            self._task = self.bot.loop.create_task(self._run(dsn))
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
+
+    def _on_notification(self, connection, pid, channel, payload):
+        self._wakeup.set()
+
+    async def drain(self):
+        while True:
+            fetch = await self.bot.db.fetch("claim_poll_events", self.batch_size, self.lease)
+            if fetch:
+                self._pending.append(([row['id'] for row in fetch], dict.fromkeys(self._buffers, 2)))
+            now = datetime.utcnow()
+            for row in fetch:
+                QUEUE_LAG.observe((now - row['polled_at']).total_seconds())
+                self.bot.coc.dispatch("on_player_trophies_change", row['old_trophies'], row['new_trophies'],
+                                      PlayerSnapshot(row))
+            QUEUE_EVENTS.inc(len(fetch), stage="handled")
+            if len(fetch) < self.batch_size:
+                return
+
+    async def _run(self, dsn):
+        backoff = 1
+        while True:
+            try:
+                self._connection = await asyncpg.connect(dsn)
+                await self._connection.add_listener(CHANNEL, self._on_notification)
+            except (OSError, asyncpg.PostgresError) as e:
+                logger.warning(f"Poll queue listener could not connect: {e}")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+                continue
+
+            backoff = 1
+            while not self._connection.is_closed():
+                self._wakeup.clear()
+                try:
+                    await self.acknowledge()
+                    await self.drain()
+                except (OSError, asyncpg.PostgresError):
+                    logger.exception("Could not drain the poll queue")
+                try:
+                    # rows written while the listener was down are picked up here too
+                    await asyncio.wait_for(self._wakeup.wait(), self.idle_interval)
+                except asyncio.TimeoutError:
+                    pass
+            logger.warning("Poll queue listener lost its connection, reconnecting")
+
+
+class WorkerPool:
+    """Runs the polling workers as child processes and restarts any that exit."""
+
+    def __init__(self, bot, count, *, restart_delay=5.0):
+        self.bot = bot
+        self.count = count
+        self.restart_delay = restart_delay
+        self._processes = {}
+        self._tasks = []
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [self.bot.loop.create_task(self._supervise(n)) for n in range(self.count)]
+
+    async def _supervise(self, index):
+        while True:
+            process = await asyncio.create_subprocess_exec(sys.executable, '-m', 'cogs.utils.workers', str(index))
+            self._processes[index] = process
+            code = await process.wait()
+            logger.warning(f"Polling worker {index} exited with code {code}, restarting")
+            await asyncio.sleep(self.restart_delay)
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        for process in self._processes.values():
+            if process.returncode is None:
+                process.terminate()
+                await process.wait()
+        self._processes.clear()
+
+
+class PollWorker:
+    """One polling shard. Stands in for the bot as far as the registry, scheduler and PushDB are concerned."""
+
+    def __init__(self, index, count, *, key_names, settings, metrics_port=None, loop=None, flush_interval=1.0):
+        self.loop = loop or asyncio.get_event_loop()
+        self.index = index
+        self.metrics_port = metrics_port
+        self.flush_interval = flush_interval
+        self.settings = settings
+        self.db = PushDB(self)
+        self.pool = None
+        self.players = PlayerRegistry(shard=(index, count))
+        self.invalidation = InvalidationBus(self)
+        self.invalidation.register("players", self.on_players_invalidated)
+        self.coc = coc.login(settings['supercell']['user'],
+                             settings['supercell']['pass'],
+                             client=coc.EventsClient,
+                             key_names=key_names,
+                             throttle_limit=40)
+        cocapi.instrument(self.coc)
+        self.coc.add_events(self.on_player_trophies_change)
+        self.poller = PollScheduler(self, self.players, **settings.get('polling', {}))
+        self._batch = []
+
+    def on_players_invalidated(self, clan_tag):
+        if clan_tag is None:
+            self.loop.create_task(self.players.load(self.db))
+        else:
+            self.loop.create_task(self.players.reload_clan(self.db, clan_tag))
+
+    async def on_player_trophies_change(self, old_trophies, new_trophies, player):
+        self._batch.append({"player_tag": player.tag,
+                            "player_name": player.name,
+                            "clan_tag": player.clan.tag if player.clan else None,
+                            "clan_name": player.clan.name if player.clan else None,
+                            "old_trophies": old_trophies,
+                            "new_trophies": new_trophies,
+                            "polled_at": datetime.utcnow().isoformat()})
+
+    async def flush(self):
+        if not self._batch:
+            return
+        batch, self._batch = self._batch, []
+        try:
+            await self.db.execute("enqueue_poll_events", batch)
+        except (OSError, asyncpg.PostgresError):
+            logger.exception(f"Could not queue {len(batch)} trophy changes, retrying")
+            self._batch[:0] = batch
+            return
+        QUEUE_EVENTS.inc(len(batch), stage="queued")
+        try:
+            await self.pool.execute("SELECT pg_notify($1, $2)", CHANNEL, str(self.index))
+        except (OSError, asyncpg.PostgresError) as e:
+            # the rows are committed; the bot's idle drain picks them up without the notify
+            logger.warning(f"Could not notify the bot of queued trophy changes: {e}")
+
+    async def run(self):
+        if self.metrics_port is not None:
+            try:
+                await metrics.start_server(self.settings.get('metrics', {}).get('host', '127.0.0.1'),
+                                           self.metrics_port)
+            except OSError as e:
+                logger.error(f"Could not start the metrics server: {e}")
+        self.pool = await self.db.create_pool(max_size=5)
+        await self.players.load(self.db)
+        self.invalidation.start(self.db.dsn)
+        self.poller.start()
+        logger.info(f"Polling worker {self.index} started with {len(self.players)} players")
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+
+if __name__ == '__main__':
+    from config import settings
+
+    index = int(sys.argv[1])
+    if 'coc_api' in settings:
+        cocapi.use_api(settings['coc_api']['url'])
+    key_names = settings['poll_workers']['key_names']
+    metrics_ports = settings['poll_workers'].get('metrics_ports', ())
+    worker = PollWorker(index, len(key_names), key_names=key_names[index], settings=settings,
+                        metrics_port=metrics_ports[index] if index < len(metrics_ports) else None)
+    worker.loop.run_until_complete(worker.run())
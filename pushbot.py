@@ -1,5 +1,6 @@
 import aiohttp
 import asyncio
+import functools
 import traceback
 import sys
 import discord
@@ -7,8 +8,14 @@ import coc
 import git
 import os
 
-from cogs.utils import context
+from cogs.utils import cache, context, cocapi, db, metrics, migrations
+from cogs.utils.claims import ClaimIndex
 from cogs.utils.db import PushDB
+from cogs.utils.invalidation import InvalidationBus
+from cogs.utils.logsink import DiscordLogSink
+from cogs.utils.outbound import OutboundQueue
+from cogs.utils.polling import PlayerRegistry, PollScheduler
+from cogs.utils.workers import PollQueue, WorkerPool
 from discord.ext import commands
 from loguru import logger
 from config import settings, emojis
@@ -20,18 +27,24 @@ if enviro == "LIVE":
     token = settings['discord']['pushToken']
     prefix = ":trophy:"
     log_level = "INFO"
+    discord_log_level = "WARNING"
     coc_names = "vps"
 elif enviro == "work":
     token = settings['discord']['testToken']
     prefix = ">"
     log_level = "DEBUG"
+    discord_log_level = "INFO"
     coc_names = "work"
 else:
     token = settings['discord']['testToken']
     prefix = ">"
     log_level = "DEBUG"
+    discord_log_level = "INFO"
     coc_names = "dev"
 
+logger.remove()
+logger.add(sys.stderr, level=log_level)
+
 description = """Discord bot used to track Clash of Clans Trophy Push Events - by TubaKid/wpmjones"""
 
 initial_extensions = ["cogs.admin",
@@ -39,6 +52,9 @@ initial_extensions = ["cogs.admin",
                       "cogs.events",
                       ]
 
+if 'coc_api' in settings:
+    cocapi.use_api(settings['coc_api']['url'])
+
 coc_client = coc.login(settings['supercell']['user'],
                        settings['supercell']['pass'],
                        client=coc.EventsClient,
@@ -57,8 +73,27 @@ class PushBot(commands.Bot):
         self.session = aiohttp.ClientSession(loop=self.loop)
         self.coc = coc_client
         self.color = discord.Color.purple()
+        self.outbound = OutboundQueue(loop=self.loop)
+        self.invalidation = InvalidationBus(self)
+        self.claims = ClaimIndex()
+        self.invalidation.register("claims", self.on_claims_invalidated)
+        self.players = PlayerRegistry()
+        self.invalidation.register("players", self.on_players_invalidated)
+        self.poller = PollScheduler(self, self.players, **settings.get('polling', {}))
+        self.poll_queue = PollQueue(self)
+        self.workers = None
+        self.outbound.start()
+        self.log_sink = DiscordLogSink(self)
+        logger.add(self.log_sink, level=discord_log_level)
+        self.log_sink.start()
+        self.loop.create_task(cache.sweep_expired())
 
         coc_client.add_events(self.on_event_error)
+        cocapi.instrument(coc_client, response_cache=cocapi.ResponseCache(**settings.get('coc_cache', {})))
+        metrics.registry.on_collect(self.collect_metrics)
+        self.metrics_runner = None
+        self.db = None
+        self.loop.create_task(self.start_metrics_server())
 
         for extension in initial_extensions:
             try:
@@ -87,11 +122,54 @@ class PushBot(commands.Bot):
     def log_channel(self):
         return self.get_channel(settings['logChannels']['push'])
 
-    def send_log(self, message):
-        asyncio.ensure_future(self.send_message(message))
-
-    async def send_message(self, message):
-        await self.log_channel.send(f"`{message}`")
+    async def start_metrics_server(self):
+        config = settings.get('metrics', {})
+        try:
+            self.metrics_runner = await metrics.start_server(config.get('host', '127.0.0.1'),
+                                                             config.get('port', 9100))
+        except OSError as e:
+            logger.error(f"Could not start the metrics server: {e}")
+
+    def collect_metrics(self):
+        outbound = metrics.registry.gauge('pushbot_outbound_depth', 'Requests waiting in the outbound queue')
+        outbound.set(self.outbound.depth)
+        counter = metrics.registry.counter('pushbot_outbound_events_total', 'Outbound queue counters by event',
+                                           ('event',))
+        for event, count in self.outbound.stats.items():
+            counter.set_total(count, event=event)
+        waited = metrics.registry.counter('pushbot_outbound_wait_seconds_total',
+                                          'Total time requests spent queued by priority', ('priority',))
+        for priority, seconds in self.outbound.wait_seconds.items():
+            waited.set_total(seconds, priority=priority)
+
+        polled = metrics.registry.gauge('pushbot_polled_players', 'Player tags in the polling set')
+        polled.set(len(self.players))
+
+        counters = {
+            'hits': metrics.registry.counter('pushbot_cache_hits_total', 'Cache hits per cached function',
+                                             ('cache',)),
+            'misses': metrics.registry.counter('pushbot_cache_misses_total', 'Cache misses per cached function',
+                                               ('cache',)),
+            'coalesced': metrics.registry.counter('pushbot_cache_coalesced_total',
+                                                  'Misses that joined a load already in flight', ('cache',)),
+            'evictions': metrics.registry.counter('pushbot_cache_evictions_total',
+                                                  'Entries evicted or expired per cached function', ('cache',)),
+            'load_time': metrics.registry.counter('pushbot_cache_load_seconds_total',
+                                                  'Total time spent loading values per cached function', ('cache',)),
+            'loads': metrics.registry.counter('pushbot_cache_loads_total', 'Loads per cached function', ('cache',)),
+        }
+        gauges = {
+            'size': metrics.registry.gauge('pushbot_cache_size', 'Entries per cached function', ('cache',)),
+            'in_flight': metrics.registry.gauge('pushbot_cache_in_flight', 'Loads in flight per cached function',
+                                                ('cache',)),
+            'bytes': metrics.registry.gauge('pushbot_cache_bytes', 'Approximate memory held by size-bounded caches',
+                                            ('cache',)),
+        }
+        for stats in cache.all_stats():
+            for attr, counter in counters.items():
+                counter.set_total(getattr(stats, attr), cache=stats.name)
+            for attr, gauge in gauges.items():
+                gauge.set(getattr(stats, attr), cache=stats.name)
 
     async def on_command_error(self, ctx, error):
         if isinstance(error, commands.NoPrivateMessage):
@@ -142,11 +220,8 @@ class PushBot(commands.Bot):
             pass
 
     async def on_ready(self):
-        logger.add(self.send_log, level="DEBUG")
         if not hasattr(self, 'uptime'):
             self.uptime = datetime.utcnow()
-        cog = self.get_cog("PushBoard")
-        await cog.update_clan_tags()
         activity = discord.Activity(type=discord.ActivityType.watching,
                                     name="trophies pile up")
         await self.change_presence(activity=activity)
@@ -161,6 +236,8 @@ class PushBot(commands.Bot):
         if ctx.command is None:
             return
 
+        # lets the slow query log name the command behind a query
+        db.current_command.set((ctx.command.cog_name, ctx.command.qualified_name))
         try:
             await self.invoke(ctx)
         finally:
@@ -173,9 +250,20 @@ class PushBot(commands.Bot):
         await self.process_commands(message)
 
     async def close(self):
+        self.log_sink.close()
+        self.outbound.close()
+        self.poller.close()
+        if self.workers is not None:
+            await self.workers.close()
+        await self.poll_queue.close()
+        await self.invalidation.close()
         await super().close()
+        if self.metrics_runner is not None:
+            await self.metrics_runner.cleanup()
         await self.session.close()
         await self.coc.close()
+        if self.db is not None:
+            await self.db.close()
 
     async def log_info(self, guild_id, message, color=None, prompt=False):
         guild_config = await self.get_guild_config(guild_id)
@@ -185,14 +273,14 @@ class PushBot(commands.Bot):
                           description=message,
                           timestamp=datetime.utcnow())
         try:
-            msg = await guild_config.log_channel.send(embed=e)
-        except (discord.Forbidden, discord.HTTPException):
+            msg = await self.outbound.send(guild_config.log_channel, embed=e)
+        except (discord.Forbidden, discord.HTTPException, asyncio.QueueFull):
             return
         if prompt:
             for n in (emojis["push"]["yes"], emojis["push"]["no"]):
                 try:
-                    await msg.add_reaction(n)
-                except (discord.Forbidden, discord.HTTPException):
+                    await self.outbound.submit(msg.channel.id, functools.partial(msg.add_reaction, n))
+                except (discord.Forbidden, discord.HTTPException, asyncio.QueueFull):
                     return msg.id
         return msg.id
 
@@ -209,19 +297,45 @@ class PushBot(commands.Bot):
             e = None
             c = message
         try:
-            await channel_config.channel.send(content=c, embed=e)
-        except (discord.Forbidden, discord.HTTPException):
+            await self.outbound.send(channel_config.channel, content=c, embed=e)
+        except (discord.Forbidden, discord.HTTPException, asyncio.QueueFull):
             return
 
-    async def get_guild(self, clan_tag):
-        sql = "SELECT guild_id FROM claims WHERE clan_tag = $1"
-        fetch = await self.pool.fetch(sql, clan_tag)
-        return [self.get_guild(n[0]) for n in fetch if self.get_guild(n[0])]
+    def get_guilds_for_clan(self, clan_tag):
+        """The guilds claiming ``clan_tag`` that this bot can see."""
+        guilds = (self.get_guild(guild_id) for guild_id in self.claims.guilds_for(clan_tag))
+        return [guild for guild in guilds if guild]
+
+    @cache.cache(strategy=cache.Strategy.revalidate, key=cache.skip_self, maxsize=5000,
+                 soft_ttl=60.0, hard_ttl=3600.0)
+    async def get_cached_clan(self, clan_tag):
+        """The clan cache every caller shares. Its soft TTL decides how stale a clan can be."""
+        return await self.coc.get_clan(clan_tag)
+
+    async def get_clans(self, clan_tags):
+        """Fetches clans through the shared clan cache, skipping any that no longer exist."""
+        results = await asyncio.gather(*(self.get_cached_clan(tag) for tag in clan_tags),
+                                       return_exceptions=True)
+        clans = []
+        for result in results:
+            if isinstance(result, coc.NotFound):
+                continue
+            if isinstance(result, BaseException):
+                raise result
+            clans.append(result)
+        return clans
+
+    def on_claims_invalidated(self, clan_tag):
+        if clan_tag is None:
+            self.loop.create_task(self.claims.load(self.db))
+        else:
+            self.loop.create_task(self.claims.reload_clan(self.db, clan_tag))
 
-    async def get_clan(self, guild_id):
-        sql = "SELECT clan_tag FROM claims WHERE guild_id = $1"
-        fetch = await self.pool.fetch(sql, guild_id)
-        return await self.coc.get_clans(n[0].strip() for n in fetch).flatten()
+    def on_players_invalidated(self, clan_tag):
+        if clan_tag is None:
+            self.loop.create_task(self.players.load(self.db))
+        else:
+            self.loop.create_task(self.players.reload_clan(self.db, clan_tag))
 
     async def get_channel_config(self, channel_id):
         cog = self.events
@@ -242,7 +356,8 @@ class PushBot(commands.Bot):
         if not cog:
             self.load_extension("cogs.pushboard")
             cog = self.get_cog("PushBoard")
-        cog._guild_coinfig_cache[guild_id] = None
+        cog.get_guild_config.invalidate(cog, guild_id)
+        asyncio.ensure_future(self.invalidation.publish("guild_config", guild_id, local=False))
 
 
 if __name__ == '__main__':
@@ -251,8 +366,19 @@ if __name__ == '__main__':
         bot.repo = git.Repo(os.getcwd())
         loop = asyncio.get_event_loop()
         bot.db = PushDB(bot)
+        for migration in loop.run_until_complete(migrations.upgrade(bot.db.dsn)):
+            logger.info(f"Applied migration {migration.version}: {migration.description}")
         pool = loop.run_until_complete(bot.db.create_pool())
         bot.pool = pool
+        loop.run_until_complete(bot.claims.load(bot.db))
+        loop.run_until_complete(bot.players.load(bot.db))
+        if 'poll_workers' in settings:
+            bot.workers = WorkerPool(bot, len(settings['poll_workers']['key_names']))
+            bot.workers.start()
+            bot.poll_queue.start(bot.db.dsn)
+        else:
+            bot.poller.start()
+        bot.invalidation.start(bot.db.dsn)
         bot.logger = logger
         bot.run(token, reconnect=True)
     except: